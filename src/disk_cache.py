@@ -0,0 +1,257 @@
+import numpy as np
+import scipy
+import scipy.sparse as sp
+import scipy.sparse.linalg
+import os
+import json
+import shutil
+import time
+import hashlib
+import inspect
+
+# A cache on disk of expensive objects that do not change between runs, such
+# as assembled matrices and their factorizations.
+#
+# Each entry is a directory of raw .npy files plus a meta.json, named by a
+# hash of the builder's name and parameters and a version stamp. The stamp
+# combines CACHE_VERSION, the numpy and scipy versions and a hash of the
+# source of the builder and of every function of its module that it calls,
+# directly or indirectly, so editing any of them invalidates the old entries.
+# numpy scalars in the parameters key the same as the Python numbers.
+# Arrays are reloaded with np.load(mmap_mode='c'), so only the pages that
+# are actually used are read. The maps are copy-on-write rather than read
+# only, as LAPACK wrappers such as lu_solve may crash on read-only arrays,
+# and writes to them stay in memory and never reach the entry. Once the entries take more than max_bytes the
+# least recently used are deleted. Temporary directories left behind by runs
+# that were killed while storing an entry are deleted after max_tmp_age
+# seconds.
+#
+# Supported values are numpy arrays, scipy sparse matrices (stored as csr
+# unless they are csc), splu objects,
+# and tuples of these and JSON scalars (e.g. from lu_factor or cho_factor).
+#
+# A reloaded splu object is a SparseLUFactor. Its first solve hands L and U
+# to SuperLU as already triangular matrices, in their own order and without
+# pivoting, which causes no fill-in and next to no arithmetic, so it costs
+# O(nnz(L) + nnz(U)), a fraction of factorizing A again. Later solves then
+# run in SuperLU's compiled triangular solves, as fast as with the original
+# object.
+
+# bump when the layout of the entries changes
+CACHE_VERSION = 1
+
+class SparseLUFactor:
+    # a reloaded splu factorization, Pr A Pc = L U
+    def __init__(self, L, U, perm_r, perm_c):
+        self.L = L
+        self.U = U
+        self.perm_r = perm_r
+        self.perm_c = perm_c
+        self.shape = L.shape
+        self.solvers = None
+
+    def triangular_solvers(self):
+        # SuperLU objects for L and for U, built on the first solve
+        if self.solvers is None:
+            self.solvers = [sp.linalg.splu(sp.csc_matrix(factor), permc_spec='NATURAL',
+                                           diag_pivot_thresh=0)
+                            for factor in (self.L, self.U)]
+        return self.solvers
+
+    def solve(self, b):
+        b = np.asarray(b)
+        if np.iscomplexobj(b) and not np.iscomplexobj(self.L):
+            # SuperLU only solves in the precision of its factors
+            return self.solve(b.real) + 1j * self.solve(b.imag)
+        solve_L, solve_U = [solver.solve for solver in self.triangular_solvers()]
+        y = np.empty(b.shape, dtype=np.result_type(b, self.L.dtype))
+        y[self.perm_r] = b
+        return solve_U(solve_L(y))[self.perm_c]
+
+def to_json(value):
+    # numpy scalars and arrays in the parameters
+    if isinstance(value, np.generic):
+        return value.item()
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    return str(value)
+
+def referenced_functions(function):
+    # function, and the functions of the same module that it refers to by
+    # name, recursively (including from lambdas and nested functions)
+    found = {}
+
+    def visit(function):
+        if function in found:
+            return
+        found[function] = None
+        codes = [function.__code__]
+        while codes:
+            code = codes.pop()
+            codes.extend(const for const in code.co_consts if inspect.iscode(const))
+            for name in code.co_names:
+                value = function.__globals__.get(name)
+                if inspect.isfunction(value) and value.__module__ == function.__module__:
+                    visit(value)
+
+    visit(function)
+    return list(found)
+
+def encode(value, arrays, prefix):
+    # returns a JSON description of value, putting any arrays into arrays
+    if isinstance(value, np.ndarray):
+        if value.dtype == object:
+            raise TypeError('object arrays cannot be memory-mapped')
+        arrays[prefix] = value
+        return {'kind': 'array', 'name': prefix}
+    if sp.issparse(value):
+        value = value.tocsr() if value.format != 'csc' else value
+        for name in ['data', 'indices', 'indptr']:
+            arrays[f'{prefix}_{name}'] = getattr(value, name)
+        return {'kind': 'sparse', 'name': prefix, 'format': value.format,
+                'shape': list(value.shape)}
+    if isinstance(value, (sp.linalg.SuperLU, SparseLUFactor)):
+        return {'kind': 'splu', 'parts': [
+            encode(part, arrays, f'{prefix}_{name}') for part, name in
+            zip([value.L.tocsr(), value.U.tocsr(), value.perm_r, value.perm_c],
+                ['L', 'U', 'perm_r', 'perm_c'])
+        ]}
+    if isinstance(value, tuple):
+        return {'kind': 'tuple', 'items': [
+            encode(item, arrays, f'{prefix}_{i}') for i, item in enumerate(value)
+        ]}
+    if isinstance(value, np.generic):
+        value = value.item()
+    if value is None or isinstance(value, (bool, int, float, str)):
+        return {'kind': 'scalar', 'value': value}
+    raise TypeError(f'cannot cache values of type {type(value)}')
+
+def decode(description, load):
+    kind = description['kind']
+    if kind == 'array':
+        return load(description['name'])
+    if kind == 'sparse':
+        name = description['name']
+        matrix = sp.csc_matrix if description['format'] == 'csc' else sp.csr_matrix
+        return matrix((load(f'{name}_data'), load(f'{name}_indices'), load(f'{name}_indptr')),
+                      shape=tuple(description['shape']), copy=False)
+    if kind == 'splu':
+        return SparseLUFactor(*[decode(part, load) for part in description['parts']])
+    if kind == 'tuple':
+        return tuple(decode(item, load) for item in description['items'])
+    return description['value']
+
+class DiskCache:
+    def __init__(self, directory='cache', max_bytes=2**32, max_tmp_age=3600):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.max_tmp_age = max_tmp_age
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(directory, exist_ok=True)
+
+    @staticmethod
+    def stamp(build):
+        digest = hashlib.blake2b(digest_size=8)
+        functions = referenced_functions(build) if inspect.isfunction(build) else [build]
+        for function in functions:
+            try:
+                source = inspect.getsource(function)
+            except (OSError, TypeError):
+                source = function.__qualname__
+            digest.update(source.encode())
+        return f'{CACHE_VERSION}-{np.__version__}-{scipy.__version__}-{digest.hexdigest()}'
+
+    def key(self, name, stamp, params):
+        description = json.dumps([name, stamp, params], default=to_json)
+        return hashlib.blake2b(description.encode(), digest_size=16).hexdigest()
+
+    def get(self, name, build, *params):
+        # build(*params), or reload it if it is already on disk
+        stamp = self.stamp(build)
+        path = os.path.join(self.directory, self.key(name, stamp, params))
+        meta_path = os.path.join(path, 'meta.json')
+        if os.path.exists(meta_path):
+            with open(meta_path) as file:
+                meta = json.load(file)
+            if meta['stamp'] == stamp:
+                self.hits += 1
+                # the modification time of meta.json records the last use
+                os.utime(meta_path)
+                return decode(meta['value'], lambda array: np.load(
+                    os.path.join(path, array + '.npy'), mmap_mode='c'
+                ))
+
+        self.misses += 1
+        value = build(*params)
+        self.store(path, name, stamp, params, value)
+        return value
+
+    def store(self, path, name, stamp, params, value):
+        arrays = {}
+        meta = {'name': name, 'stamp': stamp, 'params': json.loads(json.dumps(params, default=to_json)),
+                'value': encode(value, arrays, 'value')}
+        # write to a temporary directory and rename it, so that an interrupted
+        # run never leaves a partial entry behind
+        tmp_path = f'{path}.{os.getpid()}.tmp'
+        os.makedirs(tmp_path, exist_ok=True)
+        for array_name, array in arrays.items():
+            np.save(os.path.join(tmp_path, array_name + '.npy'), array)
+        with open(os.path.join(tmp_path, 'meta.json'), 'w') as file:
+            json.dump(meta, file)
+        try:
+            os.rename(tmp_path, path)
+        except OSError:
+            # another process stored the same entry first
+            shutil.rmtree(tmp_path, ignore_errors=True)
+        self.evict(keep=path)
+
+    def entries(self):
+        # (last used, size in bytes, name, stamp, path) of every entry
+        entries = []
+        for key in os.listdir(self.directory):
+            path = os.path.join(self.directory, key)
+            meta_path = os.path.join(path, 'meta.json')
+            if key.endswith('.tmp') or not os.path.exists(meta_path):
+                continue
+            with open(meta_path) as file:
+                meta = json.load(file)
+            size = sum(entry.stat().st_size for entry in os.scandir(path))
+            entries.append((os.path.getmtime(meta_path), size, meta['name'],
+                            meta['stamp'], path))
+        return entries
+
+    def remove_orphans(self):
+        # temporary directories of stores that never finished
+        now = time.time()
+        for key in os.listdir(self.directory):
+            path = os.path.join(self.directory, key)
+            if key.endswith('.tmp') and now - os.path.getmtime(path) > self.max_tmp_age:
+                shutil.rmtree(path, ignore_errors=True)
+
+    def evict(self, keep=None):
+        self.remove_orphans()
+        entries = sorted(self.entries())
+        # entries built by an older version of a builder are never used again
+        current = {name: stamp for _, _, name, stamp, path in entries if path == keep}
+        fresh = []
+        for entry in entries:
+            _, _, name, stamp, path = entry
+            if name in current and stamp != current[name]:
+                shutil.rmtree(path, ignore_errors=True)
+            else:
+                fresh.append(entry)
+        nbytes = sum(size for _, size, _, _, _ in fresh)
+        for _, size, _, _, path in fresh:
+            if nbytes <= self.max_bytes:
+                break
+            if path != keep:
+                shutil.rmtree(path, ignore_errors=True)
+                nbytes -= size
+
+    def nbytes(self):
+        return sum(size for _, size, _, _, _ in self.entries())
+
+    def clear(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+        os.makedirs(self.directory, exist_ok=True)
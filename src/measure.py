@@ -0,0 +1,75 @@
+import numpy as np
+import os
+import time
+import tracemalloc
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+# Time and memory of a single call, for the benchmark sweeps.
+#
+# measure(f, *args) calls f once, under tracemalloc, and records the peak
+# memory allocated through Python during the call (this includes numpy
+# arrays) and what the call left allocated, e.g. its result and anything it
+# cached. The resident set size of the process is read just before and after
+# the call, which also sees memory allocated outside Python, e.g. by SuperLU.
+#
+# tracemalloc slows down code making many small allocations, and this is
+# included in the time. With trace_memory=False the call is only timed and
+# the traced statistics are nan.
+#
+# Everything is measured relative to the start of the call, so it does not
+# include memory the process had already used, such as the history of the
+# parent that a forked sweep worker inherits. Python does not count the
+# allocations made, so blocks freed again within the call (temporaries) are
+# not in retained_blocks, only in the peak.
+
+def current_rss():
+    # resident set size of this process in bytes, or nan if it is unknown
+    try:
+        with open('/proc/self/statm') as file:
+            return int(file.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, AttributeError):
+        pass
+    if psutil is not None:
+        return psutil.Process().memory_info().rss
+    return np.nan
+
+def measure(f, *args, trace_memory=True, **kwargs):
+    # returns the result of the call, and a dict of
+    #   time: wall clock time of the call
+    #   rss_increase: growth of the resident set size over the call, in bytes
+    #   peak_traced_memory: peak bytes allocated during the call
+    #   retained_memory, retained_blocks: bytes and number of memory blocks
+    #     allocated during the call that are still allocated after it
+    traced = {'peak_traced_memory': np.nan, 'retained_memory': np.nan,
+              'retained_blocks': np.nan}
+    # measure() may be nested inside code that is already tracing
+    was_tracing = tracemalloc.is_tracing()
+    if trace_memory:
+        if not was_tracing:
+            tracemalloc.start()
+        before = tracemalloc.take_snapshot()
+        traced_before, _ = tracemalloc.get_traced_memory()
+        tracemalloc.reset_peak()
+
+    rss_before = current_rss()
+    t0 = time.perf_counter()
+    result = f(*args, **kwargs)
+    t1 = time.perf_counter()
+    rss_after = current_rss()
+
+    if trace_memory:
+        traced_after, peak = tracemalloc.get_traced_memory()
+        after = tracemalloc.take_snapshot()
+        if not was_tracing:
+            tracemalloc.stop()
+        traced['peak_traced_memory'] = peak - traced_before
+        traced['retained_memory'] = traced_after - traced_before
+        traced['retained_blocks'] = sum(
+            stat.count_diff for stat in after.compare_to(before, 'filename')
+        )
+
+    stats = {'time': t1 - t0, 'rss_increase': rss_after - rss_before, **traced}
+    return result, stats
@@ -0,0 +1,223 @@
+import numpy as np
+import scipy.sparse as sp
+import scipy.sparse.linalg
+import os
+import concurrent.futures
+import threading
+
+# Multithreaded sparse products for CSR matrices. The rows are split into
+# blocks holding roughly equal numbers of nonzeros, and each block is
+# multiplied by scipy's compiled CSR kernels, which release the GIL, so the
+# blocks run in parallel on a thread pool and write straight into their own
+# rows of the output.
+#
+# With dtype=np.float32 the values are stored in single precision, saving a
+# third of the memory of the matrix, while the products are still
+# accumulated in double precision. Each block is then multiplied a chunk of
+# about chunk_nnz nonzeros at a time: the chunk's values are copied into a
+# double precision buffer and the chunk goes through scipy's kernel, so only
+# the buffer is ever upcast, never the whole matrix. The extra copy makes the
+# products slower than with double precision values. Every thread that
+# multiplies gets its own buffer, allocated on its first product and reused
+# after that, so products may run concurrently from several threads.
+#
+# The threads are shut down by close(), or by using the operator in a with
+# statement. The adjoint A.H shares the thread pool of A, and is closed with
+# it.
+#
+# LaplacianOperator(N) is the matrix-free 5-point Laplacian of buildA(N) in
+# unit_2_6.py and unit_2_7.py.
+
+def partition_rows(indptr, n_parts):
+    # row boundaries that split the nonzeros into n_parts nearly equal parts
+    targets = np.linspace(0, indptr[-1], n_parts + 1)
+    bounds = np.searchsorted(indptr, targets)
+    bounds[0] = 0
+    bounds[-1] = len(indptr) - 1
+    return np.unique(bounds)
+
+class ParallelCSR(sp.linalg.LinearOperator):
+    def __init__(self, A, num_threads=None, dtype=None, min_nnz_per_thread=50000,
+                 chunk_nnz=2**16, pool=None):
+        # pool is an executor to run on instead of starting new threads, it
+        # is left running by close()
+        A = sp.csr_matrix(A)
+        if dtype is not None:
+            A = A.astype(dtype)
+        if num_threads is None:
+            num_threads = os.cpu_count()
+        # small matrices are not worth the cost of handing out work to threads
+        num_threads = max(1, min(num_threads, A.nnz // min_nnz_per_thread))
+        self.num_threads = num_threads
+        self.min_nnz_per_thread = min_nnz_per_thread
+        self.chunk_nnz = chunk_nnz
+        self.bounds = partition_rows(A.indptr, num_threads)
+        # the blocks of rows are the only copy of the matrix that is kept
+        self.blocks = [A[start:stop] for start, stop in zip(self.bounds[:-1], self.bounds[1:])]
+        for block in self.blocks:
+            block.sort_indices()
+        # products are always returned in at least double precision
+        dtype = np.result_type(A.dtype, np.float64)
+        # (first row, start and end in data, indptr from zero) of each chunk
+        # of each block, and the length of the largest chunk, for the buffers
+        # of upcast values
+        self.chunks = []
+        self.buffer_size = 0
+        if A.dtype != dtype:
+            for block in self.blocks:
+                bounds = partition_rows(block.indptr, max(1, block.nnz // chunk_nnz))
+                self.chunks.append([
+                    (start, block.indptr[start], block.indptr[stop],
+                     block.indptr[start:stop + 1] - block.indptr[start])
+                    for start, stop in zip(bounds[:-1], bounds[1:])
+                ])
+                largest = max(end - begin for _, begin, end, _ in self.chunks[-1])
+                self.buffer_size = max(self.buffer_size, largest)
+        self.thread_buffers = threading.local()
+        self.owns_pool = pool is None and num_threads > 1
+        self.pool = pool
+        if self.owns_pool:
+            self.pool = concurrent.futures.ThreadPoolExecutor(num_threads)
+        super().__init__(dtype, A.shape)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def block_chunks(self, i):
+        # (first row, rows) of block i in double precision, a chunk at a time.
+        # The chunks share the calling thread's buffer, so each must be used
+        # before the next
+        block = self.blocks[i]
+        if not self.chunks:
+            yield 0, block
+            return
+        buffer = getattr(self.thread_buffers, 'buffer', None)
+        if buffer is None:
+            buffer = self.thread_buffers.buffer = np.empty(self.buffer_size, dtype=self.dtype)
+        for start, begin, end, indptr in self.chunks[i]:
+            data = buffer[:end - begin]
+            data[:] = block.data[begin:end]
+            yield start, sp.csr_matrix((data, block.indices[begin:end], indptr),
+                                       shape=(len(indptr) - 1, block.shape[1]), copy=False)
+
+    def map_blocks(self, f):
+        # f(i, start) for each block i of rows, starting at row start, in order
+        indices = range(len(self.blocks))
+        starts = self.bounds[:-1]
+        if self.pool is None:
+            return [f(i, start) for i, start in zip(indices, starts)]
+        return list(self.pool.map(f, indices, starts))
+
+    def _matmat(self, X):
+        X = np.asarray(X)
+        if len(self.blocks) == 1 and not self.chunks:
+            return self.blocks[0] @ X
+        out = np.empty((self.shape[0],) + X.shape[1:], dtype=np.result_type(self.dtype, X.dtype))
+
+        def multiply(i, start):
+            for chunk_start, chunk in self.block_chunks(i):
+                rows = start + chunk_start
+                out[rows:rows + chunk.shape[0]] = chunk @ X
+        self.map_blocks(multiply)
+        return out
+
+    def _matvec(self, x):
+        return self._matmat(np.ravel(x))
+
+    def _rmatvec(self, x):
+        x = np.ravel(x)
+        out = np.zeros(self.shape[1], dtype=np.result_type(self.dtype, x.dtype))
+        for i, start in enumerate(self.bounds[:-1]):
+            for chunk_start, chunk in self.block_chunks(i):
+                rows = start + chunk_start
+                out += chunk.T @ x[rows:rows + chunk.shape[0]]
+        return out
+
+    def _adjoint(self):
+        return ParallelCSR(self.tocsr().T, self.num_threads, self.blocks[0].dtype,
+                           self.min_nnz_per_thread, self.chunk_nnz, pool=self.pool)
+
+    def tocsr(self):
+        return sp.vstack(self.blocks, format='csr')
+
+    def diagonal(self):
+        return np.concatenate([block.diagonal(k=start)
+                               for start, block in zip(self.bounds[:-1], self.blocks)]).astype(self.dtype)
+
+    @property
+    def nbytes(self):
+        # the matrix and the chunks, plus one upcast buffer per thread
+        buffer_nbytes = self.buffer_size * self.dtype.itemsize
+        return (sum(block.data.nbytes + block.indices.nbytes + block.indptr.nbytes
+                    for block in self.blocks)
+                + buffer_nbytes * self.num_threads
+                + sum(indptr.nbytes for chunks in self.chunks for *_, indptr in chunks))
+
+    def matmul_sparse(self, B):
+        # sparse times sparse: each block of rows of A times B is an
+        # independent product, and the results are stacked back together
+        B = sp.csr_matrix(B)
+
+        def multiply(i, start):
+            return sp.vstack([chunk @ B for _, chunk in self.block_chunks(i)], format='csr')
+        return sp.vstack(self.map_blocks(multiply), format='csr')
+
+    def close(self):
+        if self.owns_pool:
+            self.pool.shutdown()
+            self.owns_pool = False
+        self.pool = None
+
+class LaplacianOperator(sp.linalg.LinearOperator):
+    # matrix-free version of buildA(N): the 5-point stencil is applied to the
+    # (N-1, N-1) grid of unknowns using shifted slices, so A is never stored.
+    # matvecs write into one of `buffers` preallocated outputs in turn, so a
+    # result is overwritten `buffers` matvecs later. Two are enough for
+    # scipy's Krylov solvers, which never hold on to an older product
+    def __init__(self, N, buffers=2):
+        self.N = N
+        nvar = (N - 1)**2
+        self.buffers = [np.empty(nvar) for i in range(buffers)]
+        self.next_buffer = 0
+        super().__init__(dtype=np.dtype(float), shape=(nvar, nvar))
+
+    def apply(self, x, out):
+        # writes A @ x into the preallocated, contiguous out, without any
+        # temporaries
+        x, flat = x.reshape(-1), out.reshape(-1)
+        u = x.reshape(self.N - 1, self.N - 1)
+        v = out.reshape(self.N - 1, self.N - 1)
+        np.multiply(u, 4, out=v)
+        v[1:, :] -= u[:-1, :]
+        v[:-1, :] -= u[1:, :]
+        # the left and right neighbours are shifts of the flat vectors, as
+        # strided column slices would make numpy buffer them, and the terms
+        # that wrap around from the neighbouring row are added back
+        flat[1:] -= x[:-1]
+        v[1:, 0] += u[:-1, -1]
+        flat[:-1] -= x[1:]
+        v[:-1, -1] += u[1:, 0]
+        v *= self.N**2
+        return out
+
+    def _matvec(self, x):
+        x = np.ravel(x)
+        if np.result_type(x, float) != float:
+            # e.g. complex vectors, which do not fit the buffers
+            return self.apply(x, np.empty(self.shape[0], dtype=np.result_type(x, float)))
+        out = self.buffers[self.next_buffer]
+        self.next_buffer = (self.next_buffer + 1) % len(self.buffers)
+        return self.apply(x, out)
+
+    def _rmatvec(self, x):
+        # the operator is symmetric
+        return self._matvec(x)
+
+    def _adjoint(self):
+        return self
+
+    def diagonal(self):
+        return np.full(self.shape[0], 4.0 * self.N**2)
@@ -1,9 +1,27 @@
+import json
 import numpy as np
 import matplotlib.pyplot as plt
-x = np.linspace(0, 1e6, 10)
-plt.plot(x, 8.0 * (x**2) / 1e6, lw=5)
+
+# memory measured by the LU timing sweep in unit_2_4.py, run that first
+with open('unit_2_4_memory.json') as file:
+    records = json.load(file)
+
+for solver in ['dense LU', 'sparse LU', 'banded LU']:
+    n = np.array([r['N'] for r in records if r['solver'] == solver])
+    memory = np.array([r['peak_traced_memory'] for r in records if r['solver'] == solver])
+    label = solver
+    if solver == 'sparse LU':
+        # SuperLU allocates its factors outside of Python's allocator, where
+        # tracemalloc does not see them. The measured rss_increase does, but
+        # also counts pages the worker touches for other reasons, so this adds
+        # an estimate of the factor storage (8 byte values and 4 byte indices)
+        # to the traced memory instead
+        memory += 12 * np.array([r['factor_nnz'] for r in records if r['solver'] == solver])
+        label = 'sparse LU (traced + estimated factors)'
+    plt.loglog(n, memory / 1e6, lw=5, label=label)
 
 plt.xlabel(r'size $n$')
 
 plt.ylabel('memory [MB]')
+plt.legend()
 plt.savefig('sparse_versus_dense.svg')
@@ -0,0 +1,181 @@
+import numpy as np
+import os
+import json
+import time
+import multiprocessing
+import multiprocessing.connection
+import warnings
+try:
+    from threadpoolctl import threadpool_limits
+except ImportError:
+    threadpool_limits = None
+
+# Run the cells of a benchmark sweep, e.g. every (right-hand side, N, method)
+# combination, each in its own forked worker process, up to max_workers at a
+# time.
+#
+# cells maps the index of each cell in the output arrays to the arguments of
+# cell(*args), which returns a dict of results. Any result whose name is in
+# outputs is written to outputs[name][index], so the arrays keep the shapes
+# the serial loops used. The full dict of results for each finished cell is
+# returned.
+#
+# A cell that takes longer than timeout seconds is killed by the parent, so
+# the timeout also applies inside long compiled calls (e.g. LAPACK). It
+# leaves nan in the outputs and is missing from the returned results. Without
+# fork (e.g. on Windows) the cells run in this process and there is no
+# timeout.
+#
+# Every finished cell is appended to the checkpoint file (json lines) together
+# with its arguments, and cells found there with the same arguments are not
+# run again, so an interrupted sweep resumes where it stopped. Timed out
+# cells are not checkpointed, so they are retried on resume. The checkpoint
+# is removed once every cell has finished.
+#
+# Each worker limits its BLAS threads to its share of the cores, which needs
+# threadpoolctl. Without it the sweep warns, and the workers can
+# oversubscribe the cores.
+
+def to_json(value):
+    # numpy scalars and arrays in the results
+    if isinstance(value, np.generic):
+        return value.item()
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    raise TypeError(f'{type(value)} is not JSON serializable')
+
+def normalise_args(args):
+    # the arguments as they read back from the checkpoint
+    return json.loads(json.dumps(list(args), default=to_json))
+
+def load_checkpoint(checkpoint, cells):
+    results = {}
+    if checkpoint is None or not os.path.exists(checkpoint):
+        return results
+    with open(checkpoint) as file:
+        lines = file.read()
+    for line in lines.splitlines():
+        try:
+            entry = json.loads(line)
+        except json.JSONDecodeError:
+            # the last line is partial if the sweep was killed mid-write
+            continue
+        index = tuple(entry['index'])
+        # entries from a sweep over different cells are ignored
+        if index in cells and entry.get('args') == normalise_args(cells[index]):
+            results[index] = entry['result']
+    if lines and not lines.endswith('\n'):
+        # so that new cells are appended after the partial line, not onto it
+        with open(checkpoint, 'a') as file:
+            file.write('\n')
+    return results
+
+def limit_blas_threads(blas_threads):
+    # limit BLAS threads so that the workers do not oversubscribe the cores,
+    # returns the limits (keep them alive), or None without threadpoolctl
+    if threadpool_limits is None:
+        return None
+    return threadpool_limits(blas_threads)
+
+def warn_unlimited_blas_threads(blas_threads):
+    # called in the parent, so that the warning is given once, not per worker
+    if threadpool_limits is None and blas_threads < os.cpu_count():
+        warnings.warn(f'threadpoolctl is not installed, so BLAS in the workers is not '
+                      f'limited to {blas_threads} threads and may oversubscribe the cores',
+                      stacklevel=3)
+
+def run_cell(connection, cell, args, blas_threads):
+    # runs in the forked worker, and sends back ('result', value) or
+    # ('error', exception)
+    try:
+        limits = limit_blas_threads(blas_threads)
+        connection.send(('result', cell(*args)))
+    except BaseException as error:
+        connection.send(('error', error))
+    finally:
+        connection.close()
+
+def run_sweep(cell, cells, outputs=None, checkpoint=None, timeout=None,
+              max_workers=None):
+    if outputs is None:
+        outputs = {}
+    results = load_checkpoint(checkpoint, cells)
+    todo = [(index, args) for index, args in cells.items() if index not in results]
+    if results:
+        print('resuming from', checkpoint, 'with', len(results), 'cells done')
+
+    def finish(index, result):
+        results[index] = result
+        if checkpoint is not None:
+            file.write(json.dumps({'index': index, 'args': normalise_args(cells[index]),
+                                   'result': result}, default=to_json) + '\n')
+            file.flush()
+
+    timed_out = []
+    file = open(checkpoint, 'a') if checkpoint is not None else None
+    try:
+        if max_workers is None:
+            max_workers = os.cpu_count()
+        if 'fork' not in multiprocessing.get_all_start_methods():
+            for index, args in todo:
+                finish(index, cell(*args))
+        else:
+            # workers are forked, as spawning them would re-run the calling script
+            context = multiprocessing.get_context('fork')
+            blas_threads = max(1, os.cpu_count() // max_workers)
+            warn_unlimited_blas_threads(blas_threads)
+            running = {}
+            todo.reverse()
+            try:
+                while todo or running:
+                    while todo and len(running) < max_workers:
+                        index, args = todo.pop()
+                        receiver, sender = context.Pipe(duplex=False)
+                        process = context.Process(target=run_cell,
+                                                  args=(sender, cell, args, blas_threads))
+                        process.start()
+                        sender.close()
+                        deadline = np.inf if timeout is None else time.monotonic() + timeout
+                        running[receiver] = (index, process, deadline)
+
+                    wait = min(deadline for _, _, deadline in running.values()) - time.monotonic()
+                    ready = multiprocessing.connection.wait(
+                        list(running), timeout=None if wait == np.inf else max(wait, 0)
+                    )
+                    for receiver in ready:
+                        index, process, _ = running.pop(receiver)
+                        try:
+                            kind, value = receiver.recv()
+                        except EOFError:
+                            process.join()
+                            raise RuntimeError(f'cell {index} died with exit code {process.exitcode}')
+                        receiver.close()
+                        process.join()
+                        if kind == 'error':
+                            raise value
+                        finish(index, value)
+                    now = time.monotonic()
+                    for receiver, (index, process, deadline) in list(running.items()):
+                        if now >= deadline:
+                            process.kill()
+                            process.join()
+                            receiver.close()
+                            del running[receiver]
+                            timed_out.append(index)
+                            print('cell', index, 'timed out')
+            finally:
+                for receiver, (index, process, _) in running.items():
+                    process.kill()
+                    process.join()
+                    receiver.close()
+    finally:
+        if file is not None:
+            file.close()
+
+    for index, result in results.items():
+        for name, value in result.items():
+            if name in outputs:
+                outputs[name][index] = value
+    if checkpoint is not None and not timed_out:
+        os.remove(checkpoint)
+    return results
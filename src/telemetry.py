@@ -0,0 +1,109 @@
+import numpy as np
+import scipy.sparse.linalg
+import time
+import json
+
+# What an iterative solver did: the relative residual each time it was
+# checked, the wall time at which it was checked, the number of matvecs and
+# preconditioner applications, why the solver stopped, and the true relative
+# residual |b - A x| / |b| of the solution it returned.
+#
+# residual_type says what the recorded residuals are: 'true' for |b - A x_k|
+# / |b|, or 'preconditioned' when the solver reports the norm of its own
+# (preconditioned) residual, as scipy's gmres does.
+#
+# Solvers take telemetry=None and fall back to a disabled SolverTelemetry,
+# which only counts iterations, so leaving it off costs next to nothing.
+# With enabled=True the residuals and times go into preallocated arrays, and
+# if an exporter is given, e.g. JsonLinesExporter('telemetry.jsonl'), the
+# record is passed to it when the solver finishes.
+
+class SolverTelemetry:
+    def __init__(self, max_iter=1000, enabled=True, exporter=None, residual_type='true',
+                 **labels):
+        self.enabled = enabled
+        self.exporter = exporter
+        self.residual_type = residual_type
+        self.labels = labels
+        self.iterations = 0
+        self.matvecs = 0
+        self.preconditioner_applies = 0
+        self.reason = None
+        self.final_residual = np.nan
+        self.total_time = np.nan
+        self.residuals = np.full(max_iter + 1 if enabled else 0, np.nan)
+        self.times = np.full(max_iter + 1 if enabled else 0, np.nan)
+        self.start_time = time.perf_counter()
+
+    def record(self, residual=np.nan):
+        if self.enabled:
+            if self.iterations == len(self.residuals):
+                # the solver ran on for longer than max_iter, so make room
+                self.residuals = np.concatenate([self.residuals, np.full(len(self.residuals) + 1, np.nan)])
+                self.times = np.concatenate([self.times, np.full(len(self.times) + 1, np.nan)])
+            self.residuals[self.iterations] = residual
+            self.times[self.iterations] = time.perf_counter() - self.start_time
+        self.iterations += 1
+
+    def finish(self, reason, final_residual=np.nan):
+        self.reason = reason
+        self.final_residual = final_residual
+        self.total_time = time.perf_counter() - self.start_time
+        if self.enabled:
+            self.residuals = self.residuals[:self.iterations]
+            self.times = self.times[:self.iterations]
+            if self.exporter is not None:
+                self.exporter(self)
+        return self
+
+    @property
+    def iteration_times(self):
+        # wall time taken by each iteration
+        return np.diff(self.times, prepend=0.0)
+
+    def count_matvecs(self, A):
+        # wrap A so that scipy's solvers count its matvecs here
+        if not self.enabled or A is None:
+            return A
+        A = scipy.sparse.linalg.aslinearoperator(A)
+
+        def matvec(x):
+            self.matvecs += 1
+            return A.matvec(x)
+        return scipy.sparse.linalg.LinearOperator(A.shape, matvec=matvec, dtype=A.dtype)
+
+    def count_preconditioner_applies(self, M):
+        if not self.enabled or M is None:
+            return M
+        M = scipy.sparse.linalg.aslinearoperator(M)
+
+        def matvec(x):
+            self.preconditioner_applies += 1
+            return M.matvec(x)
+        return scipy.sparse.linalg.LinearOperator(M.shape, matvec=matvec, dtype=M.dtype)
+
+    def as_dict(self):
+        return {
+            **self.labels, 'iterations': self.iterations, 'reason': self.reason,
+            'final_residual': self.final_residual, 'residual_type': self.residual_type,
+            'matvecs': self.matvecs, 'preconditioner_applies': self.preconditioner_applies,
+            'total_time': self.total_time, 'residuals': self.residuals.tolist(),
+            'iteration_times': self.iteration_times.tolist(),
+        }
+
+class JsonLinesExporter:
+    # appends one JSON object per finished solve to filename
+    def __init__(self, filename):
+        self.filename = filename
+
+    def __call__(self, telemetry):
+        with open(self.filename, 'a') as file:
+            file.write(json.dumps(telemetry.as_dict()) + '\n')
+
+def reason_from_info(info):
+    # the info flag returned by scipy's Krylov solvers
+    if info == 0:
+        return 'converged'
+    if info > 0:
+        return 'max_iter'
+    return 'breakdown'
@@ -22,14 +22,22 @@ plot_lines(0, 0, 0)
 plot_lines(2, -1, 1)
 
 
-def solve_triangular(A, b):
+def solve_triangular(A, b, lower=False, unit_diagonal=False):
+    # b can be a single vector (n,) or k right-hand sides (n, k), each step
+    # updates row i of x for all right-hand sides at once
     n = len(b)
-    x = np.empty_like(b)
-    for i in range(n-1, -1, -1):
-        x[i] = b[i]
-        for j in range(n-1, i, -1):
-            x[i] -= A[i, j] * x[j]
-        x[i] /= A[i, i]
+    x = np.empty(b.shape, dtype=np.result_type(A, b, float))
+    if lower:
+        rows = range(0, n)
+    else:
+        rows = range(n-1, -1, -1)
+    for i in rows:
+        if lower:
+            x[i] = b[i] - A[i, :i] @ x[:i]
+        else:
+            x[i] = b[i] - A[i, i+1:] @ x[i+1:]
+        if not unit_diagonal:
+            x[i] /= A[i, i]
     return x
 
 def random_upper_triangular(n):
@@ -60,4 +68,15 @@ for A, b in zip(As, bs):
     x_mine = solve_triangular(A, b)
     np.testing.assert_almost_equal(x_scipy, x_mine)
 
-
+# several right-hand sides at once, and forward substitution on the lower
+# triangle with an implicit unit diagonal, as stored in a packed LU matrix
+for A, b in zip(As, bs):
+    n = len(b)
+    B = np.random.rand(n, 3)
+    np.testing.assert_almost_equal(
+        scipy.linalg.solve_triangular(A, B), solve_triangular(A, B)
+    )
+    np.testing.assert_almost_equal(
+        scipy.linalg.solve_triangular(A.T, B, lower=True, unit_diagonal=True),
+        solve_triangular(A.T, B, lower=True, unit_diagonal=True)
+    )
@@ -3,50 +3,127 @@ import matplotlib.pylab as plt
 import scipy
 import scipy.linalg
 import sys
+import time
+import tracemalloc
 
-def solve_triangular(A, b):
-    n = len(b)
-    x = np.empty_like(b)
-    for i in range(n-1, -1, -1):
-        x[i] = b[i]
-        for j in range(n-1, i, -1):
-            x[i] -= A[i, j] * x[j]
-        x[i] /= A[i, i]
+def solve_triangular(A, b, lower=False, unit_diagonal=False):
+    # b can be a single vector (n,) or k right-hand sides (n, k), each step
+    # updates row i of x for all right-hand sides at once.
+    # A stack of matrices (B, n, n) with right-hand sides (B, n) is solved
+    # all at once, and a zero on a diagonal gives inf or nan in that x only
+    batched = A.ndim == 3
+    n = b.shape[-1] if batched else len(b)
+    x = np.empty(b.shape, dtype=np.result_type(A, b, float))
+    if lower:
+        rows = range(0, n)
+    else:
+        rows = range(n-1, -1, -1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        for i in rows:
+            if batched and lower:
+                x[:, i] = b[:, i] - np.einsum('bj,bj->b', A[:, i, :i], x[:, :i])
+            elif batched:
+                x[:, i] = b[:, i] - np.einsum('bj,bj->b', A[:, i, i+1:], x[:, i+1:])
+            elif lower:
+                x[i] = b[i] - A[i, :i] @ x[:i]
+            else:
+                x[i] = b[i] - A[i, i+1:] @ x[i+1:]
+            if not unit_diagonal and batched:
+                x[:, i] /= A[:, i, i]
+            elif not unit_diagonal:
+                x[i] /= A[i, i]
     return x
 
 
-def gaussian_elimination(A):
+def gaussian_elimination(A, b=None, work=None):
+    # A (and the right-hand side b, if given) are eliminated in place, and
+    # work is an optional preallocated row buffer of length n, so no O(n^2)
+    # temporaries are created.
+    # A stack of matrices (B, m, n), with right-hand sides b (B, m), is
+    # eliminated all at once, and instead of raising, matrices with no pivot
+    # in some column are flagged in the returned singular array
+    if A.ndim == 3:
+        B, m, n = A.shape
+        batch = np.arange(B)
+        singular = np.zeros(B, dtype=bool)
+        for k in range(min(m, n)):
+            # Find the k-th pivot of every matrix in the batch:
+            i_max = np.argmax(np.abs(A[:, k:, k]), axis=1) + k
+            pivot = A[batch, i_max, k]
+            # No pivot in this column, flag the matrix and leave the column alone
+            singular |= pivot == 0
+            pivot[pivot == 0] = 1
+            # swap rows
+            rows = A[batch, i_max, :]
+            A[batch, i_max, :] = A[:, k, :]
+            A[:, k, :] = rows
+            if b is not None:
+                rows = b[batch, i_max]
+                b[batch, i_max] = b[:, k]
+                b[:, k] = rows
+            # eliminate all rows below pivot, in all matrices at once
+            f = A[:, k+1:, k] / pivot[:, np.newaxis]
+            A[:, k+1:, k] = 0
+            A[:, k+1:, k+1:] -= f[:, :, np.newaxis] * A[:, np.newaxis, k, k+1:]
+            if b is not None:
+                b[:, k+1:] -= f * b[:, k, np.newaxis]
+        return A, singular
+
     m, n = A.shape
+    if work is None:
+        work = np.empty(n, dtype=A.dtype)
 
     # initialise the pivot row and column
     h = 0
     k = 0
     while h < m and k < n:
         # Find the k-th pivot:
-        i_max = np.argmax(A[h:, k]) + h
+        i_max = np.argmax(np.abs(A[h:, k])) + h
         if A[i_max, k] == 0:
             # No pivot in this column, pass to next column
             k = k+1
         else:
-            # swap rows
-            A[[h, i_max], :] = A[[i_max, h], :]
+            # swap rows, through the work buffer
+            if i_max != h:
+                work[:] = A[h]
+                A[h] = A[i_max]
+                A[i_max] = work
+                if b is not None:
+                    b[[h, i_max]] = b[[i_max, h]]
             # Do for all rows below pivot:
             for i in range(h+1, m):
                 f = A[i, k] / A[h, k]
                 # Fill with zeros the lower part of pivot column:
                 A[i, k] = 0
                 # Do for all remaining elements in current row:
-                for j in range(k + 1, n):
-                    A[i, j] = A[i, j] - A[h, j] * f
+                np.multiply(A[h, k+1:], f, out=work[k+1:])
+                A[i, k+1:] -= work[k+1:]
+                if b is not None:
+                    b[i] -= b[h] * f
             # Increase pivot row and column
             h = h + 1
             k = k + 1
     return A
 
-def solve_gaussian_elimination(A, b):
-    augmented_system = np.concatenate((A, b.reshape(-1, 1)), axis=1)
-    gaussian_elimination(augmented_system)
-    return solve_triangular(augmented_system[:, :-1], augmented_system[:, -1])
+def solve_gaussian_elimination(A, b, overwrite_a=False, overwrite_b=False, work=None):
+    # with overwrite_a/overwrite_b the elimination happens in the caller's
+    # buffers, which must then already be floating point.
+    # For a stack of systems, A (B, n, n) and b (B, n), this returns x and
+    # the per-matrix singular flags
+    if overwrite_a and not np.issubdtype(A.dtype, np.floating):
+        raise TypeError(f'overwrite_a needs a floating point A, not {A.dtype}')
+    if overwrite_b and not np.issubdtype(b.dtype, np.floating):
+        raise TypeError(f'overwrite_b needs a floating point b, not {b.dtype}')
+    dtype = np.result_type(A, b, float)
+    if not overwrite_a:
+        A = np.array(A, dtype=dtype)
+    if not overwrite_b:
+        b = np.array(b, dtype=dtype)
+    if A.ndim == 3:
+        _, singular = gaussian_elimination(A, b)
+        return solve_triangular(A, b), singular
+    gaussian_elimination(A, b, work)
+    return solve_triangular(A, b)
 
 def random_matrix(n):
     R = np.random.rand(n, n)
@@ -82,6 +159,71 @@ for A, b in zip(As, bs):
     x_mine = solve_gaussian_elimination(A, b)
     np.testing.assert_almost_equal(x_scipy, x_mine)
 
+# in place elimination allocates no O(n^2) temporaries
+n = 300
+A = random_non_singular_matrix(n)
+b = np.random.rand(n)
+x_scipy = scipy.linalg.solve(A, b)
+work = np.empty(n)
+tracemalloc.start()
+x_mine = solve_gaussian_elimination(A, b, overwrite_a=True, overwrite_b=True, work=work)
+_, peak = tracemalloc.get_traced_memory()
+tracemalloc.stop()
+np.testing.assert_almost_equal(x_scipy, x_mine)
+print('peak memory of in place solve is', peak, 'bytes, versus', A.nbytes, 'bytes for A')
+assert peak < A.nbytes / 10
+
+# integer buffers cannot hold the eliminated values
+for overwrite_a, overwrite_b in [(True, False), (False, True)]:
+    try:
+        solve_gaussian_elimination(As[0], bs[0], overwrite_a, overwrite_b)
+    except TypeError:
+        pass
+    else:
+        raise AssertionError('integer buffers were overwritten')
+
+# solve a whole stack of systems at once, with one singular matrix in the stack
+A_batch = np.array([random_non_singular_matrix(4) for i in range(10)])
+A_batch[3, :, 0] = 0
+b_batch = np.random.rand(10, 4)
+x_batch, singular = solve_gaussian_elimination(A_batch, b_batch)
+np.testing.assert_equal(singular, np.arange(10) == 3)
+for A, b, x in zip(A_batch[~singular], b_batch[~singular], x_batch[~singular]):
+    np.testing.assert_almost_equal(scipy.linalg.solve(A, b), x)
+
+# the batched and the single matrix elimination pick the same pivots, here
+# the largest magnitude entry of the first column is negative
+A_batch = np.array([random_non_singular_matrix(4) for i in range(10)])
+A_batch[:, 2, 0] = -10
+A_looped = np.array([gaussian_elimination(np.array(A)) for A in A_batch])
+A_eliminated, _ = gaussian_elimination(np.array(A_batch))
+np.testing.assert_almost_equal(A_eliminated, A_looped)
+
+# lower triangular stacks go through the same solve_triangular
+L_batch = np.tril(A_batch) + 4 * np.eye(4)
+for L, b, x in zip(L_batch, b_batch, solve_triangular(L_batch, b_batch, lower=True)):
+    np.testing.assert_almost_equal(scipy.linalg.solve_triangular(L, b, lower=True), x)
+
+# throughput in systems per second, versus a loop over scipy.linalg.solve
+B = 10000
+for n in [3, 8, 16, 32]:
+    A_batch = np.random.rand(B, n, n)
+    b_batch = np.random.rand(B, n)
+
+    t0 = time.perf_counter()
+    for A, b in zip(A_batch, b_batch):
+        scipy.linalg.solve(A, b)
+    t1 = time.perf_counter()
+    loop_rate = B / (t1 - t0)
+
+    t0 = time.perf_counter()
+    solve_gaussian_elimination(A_batch, b_batch)
+    t1 = time.perf_counter()
+    batched_rate = B / (t1 - t0)
+
+    print('n =', n, 'scipy loop:', int(loop_rate), 'systems/s, batched:',
+          int(batched_rate), 'systems/s')
+
 A = np.array([
     [4.5, 3.1],
     [1.6, 1.1],
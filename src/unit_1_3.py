@@ -3,37 +3,111 @@ import matplotlib.pylab as plt
 import scipy
 import scipy.linalg
 import sys
+import time
+import hashlib
+import collections
+
+def lu_decomposition(A, overwrite_a=False, work=None):
+    # with overwrite_a the factors are stored in A itself, and work is an
+    # optional preallocated row buffer of length n used for the row updates.
+    # A stack of matrices (B, m, n) is factored all at once, returning
+    # (LU, pivots, singular), where singular flags the matrices with no
+    # pivot in some column instead of raising
+    if overwrite_a and not np.issubdtype(A.dtype, np.floating):
+        raise TypeError(f'overwrite_a needs a floating point A, not {A.dtype}')
+    if A.ndim == 3:
+        B, m, n = A.shape
+        batch = np.arange(B)
+
+        if overwrite_a:
+            LU = A
+        else:
+            LU = np.array(A, dtype=np.result_type(A.dtype, float))
+        pivots = np.empty((B, min(m, n)), dtype=int)
+        singular = np.zeros(B, dtype=bool)
+        for k in range(min(m, n)):
+            # Find the k-th pivot of every matrix in the batch:
+            pivots[:, k] = np.argmax(np.abs(LU[:, k:, k]), axis=1) + k
+            pivot = LU[batch, pivots[:, k], k]
+            # No pivot in this column, flag the matrix and leave the column alone
+            singular |= pivot == 0
+            pivot[pivot == 0] = 1
+            # swap rows
+            rows = LU[batch, pivots[:, k], :]
+            LU[batch, pivots[:, k], :] = LU[:, k, :]
+            LU[:, k, :] = rows
+            # Store f as the new L column values and update the rows below pivot
+            LU[:, k+1:, k] /= pivot[:, np.newaxis]
+            LU[:, k+1:, k+1:] -= LU[:, k+1:, k, np.newaxis] * LU[:, np.newaxis, k, k+1:]
+        return LU, pivots, singular
 
-def lu_decomposition(A):
     m, n = A.shape
 
-    LU = np.copy(A)
+    if overwrite_a:
+        LU = A
+    else:
+        LU = np.array(A, dtype=np.result_type(A.dtype, float))
+    if work is None:
+        work = np.empty(n, dtype=LU.dtype)
     pivots = np.empty(n, dtype=int)
     # initialise the pivot row and column
     h = 0
     k = 0
     while h < m and k < n:
         # Find the k-th pivot:
-        pivots[k] = np.argmax(LU[h:, k]) + h
+        pivots[k] = np.argmax(np.abs(LU[h:, k])) + h
         if LU[pivots[k], k] == 0:
             # No pivot in this column, pass to next column
             k = k+1
         else:
-            # swap rows
-            LU[[h, pivots[k]], :] = LU[[pivots[k], h], :]
+            # swap rows, through the work buffer
+            if pivots[k] != h:
+                work[:] = LU[h]
+                LU[h] = LU[pivots[k]]
+                LU[pivots[k]] = work
             # Do for all rows below pivot:
             for i in range(h+1, m):
                 f = LU[i, k] / LU[h, k]
                 # Store f as the new L column values
                 LU[i, k] = f
                 # Do for all remaining elements in current row:
-                for j in range(k + 1, n):
-                    LU[i, j] = LU[i, j] - LU[h, j] * f
+                np.multiply(LU[h, k+1:], f, out=work[k+1:])
+                LU[i, k+1:] -= work[k+1:]
             # Increase pivot row and column
             h = h + 1
             k = k + 1
     return LU, pivots
 
+def lu_decomposition_blocked(A, block_size=64):
+    m, n = A.shape
+
+    # keep single precision input in single precision, everything else in double
+    LU = np.array(A, dtype=np.result_type(A.dtype, np.float32))
+    pivots = np.arange(min(m, n))
+    # loop over panels of block_size columns
+    for k0 in range(0, min(m, n), block_size):
+        k1 = min(k0 + block_size, min(m, n))
+        # factor the panel LU[k0:, k0:k1] one column at a time
+        for k in range(k0, k1):
+            # Find the k-th pivot (largest magnitude in column):
+            pivots[k] = np.argmax(np.abs(LU[k:, k])) + k
+            if pivots[k] != k:
+                # swap whole rows, so L to the left and A to the right follow
+                LU[[k, pivots[k]], :] = LU[[pivots[k], k], :]
+            if LU[k, k] != 0:
+                # Store f as the new L column values
+                LU[k+1:, k] /= LU[k, k]
+            # rank-1 update restricted to the rest of the panel
+            LU[k+1:, k+1:k1] -= np.outer(LU[k+1:, k], LU[k, k+1:k1])
+        if k1 < n:
+            # block row of U: U12 = L11^{-1} A12
+            LU[k0:k1, k1:] = scipy.linalg.solve_triangular(
+                LU[k0:k1, k0:k1], LU[k0:k1, k1:], lower=True, unit_diagonal=True
+            )
+            # update the trailing matrix with a single matrix-matrix product
+            LU[k1:, k1:] -= LU[k1:, k0:k1] @ LU[k0:k1, k1:]
+    return LU, pivots
+
 def random_matrix(n):
     R = np.random.rand(n, n)
     A = np.zeros((n, n))
@@ -68,6 +142,110 @@ def calculate_L_mult_U(LU):
     U = np.triu(LU)
     return L @ U
 
+def solve_triangular(A, b, lower=False, unit_diagonal=False):
+    # b can be a single vector (n,) or k right-hand sides (n, k), each step
+    # updates row i of x for all right-hand sides at once.
+    # A stack of matrices (B, n, n) with right-hand sides (B, n) is solved
+    # all at once, and a zero on a diagonal gives inf or nan in that x only
+    batched = A.ndim == 3
+    n = b.shape[-1] if batched else len(b)
+    x = np.empty(b.shape, dtype=np.result_type(A, b, float))
+    if lower:
+        rows = range(0, n)
+    else:
+        rows = range(n-1, -1, -1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        for i in rows:
+            if batched and lower:
+                x[:, i] = b[:, i] - np.einsum('bj,bj->b', A[:, i, :i], x[:, :i])
+            elif batched:
+                x[:, i] = b[:, i] - np.einsum('bj,bj->b', A[:, i, i+1:], x[:, i+1:])
+            elif lower:
+                x[i] = b[i] - A[i, :i] @ x[:i]
+            else:
+                x[i] = b[i] - A[i, i+1:] @ x[i+1:]
+            if not unit_diagonal and batched:
+                x[:, i] /= A[:, i, i]
+            elif not unit_diagonal:
+                x[i] /= A[i, i]
+    return x
+
+class LUFactorization:
+    # factor A once, then solve against as many right-hand sides as needed
+    def __init__(self, A):
+        self.LU, self.pivots = lu_decomposition_blocked(A)
+        self.row_indices = pivots_to_row_indices(self.pivots)
+        self.nbytes = self.LU.nbytes + self.pivots.nbytes + self.row_indices.nbytes
+
+    def solve(self, b):
+        y = solve_triangular(self.LU, b[self.row_indices], lower=True, unit_diagonal=True)
+        return solve_triangular(self.LU, y)
+
+class LUCache:
+    # least recently used factorizations are evicted once the total size of
+    # the stored factors goes over max_bytes
+    def __init__(self, max_bytes=2**30):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.factorizations = collections.OrderedDict()
+
+    @staticmethod
+    def fingerprint(A):
+        A = np.ascontiguousarray(A)
+        digest = hashlib.blake2b(A.tobytes(), digest_size=16).hexdigest()
+        return A.shape, A.dtype.str, digest
+
+    def factorize(self, A):
+        key = self.fingerprint(A)
+        if key in self.factorizations:
+            self.hits += 1
+            self.factorizations.move_to_end(key)
+            return self.factorizations[key]
+
+        self.misses += 1
+        lu = LUFactorization(A)
+        self.factorizations[key] = lu
+        self.nbytes += lu.nbytes
+        while self.nbytes > self.max_bytes and len(self.factorizations) > 1:
+            _, evicted = self.factorizations.popitem(last=False)
+            self.nbytes -= evicted.nbytes
+        return lu
+
+    def solve(self, A, b):
+        return self.factorize(A).solve(b)
+
+def solve_mixed_precision(A, b, tol=None, max_iter=10):
+    # factor in single precision, then recover double precision accuracy by
+    # iterative refinement using double precision residuals
+    n = len(b)
+    if tol is None:
+        tol = np.sqrt(n) * np.finfo(np.float64).eps
+    lu = LUFactorization(A.astype(np.float32))
+
+    # refinement only converges if cond(A) * eps_single < 1, so fall back to a
+    # double precision factorization if the LAPACK condition estimate is too big
+    A_norm = np.linalg.norm(A, 1)
+    rcond, _ = scipy.linalg.lapack.sgecon(lu.LU, A_norm)
+    if rcond < 10 * np.finfo(np.float32).eps:
+        return LUFactorization(A).solve(b), 0, True
+
+    # returns x, the number of refinement steps taken, and whether it had to
+    # fall back to double precision factors
+    x = lu.solve(b)
+    corrections = 0
+    while True:
+        r = b - A @ x
+        if np.linalg.norm(r, 1) <= tol * A_norm * np.linalg.norm(x, 1):
+            return x, corrections, False
+        if corrections == max_iter:
+            break
+        x += lu.solve(r)
+        corrections += 1
+    # refinement did not reach tol within max_iter steps
+    return LUFactorization(A).solve(b), corrections, True
+
 for A in As:
     LU_scipy, pivots_scipy = scipy.linalg.lu_factor(A)
     row_indices_scipy = pivots_to_row_indices(pivots_scipy)
@@ -77,3 +255,119 @@ for A in As:
     np.testing.assert_almost_equal(calculate_L_mult_U(LU_scipy),  A[row_indices_scipy])
     np.testing.assert_almost_equal(calculate_L_mult_U(LU_mine),  A[row_indices_mine])
 
+    A_inplace = np.array(A, dtype=float)
+    LU_inplace, pivots_inplace = lu_decomposition(A_inplace, overwrite_a=True, work=np.empty(len(A)))
+    assert LU_inplace is A_inplace
+    np.testing.assert_almost_equal(LU_inplace, LU_mine)
+
+    # an integer A cannot hold the factors
+    try:
+        lu_decomposition(A.astype(int), overwrite_a=True)
+    except TypeError:
+        pass
+    else:
+        raise AssertionError('an integer A was overwritten')
+
+    for block_size in [2, 64]:
+        LU_blocked, pivots_blocked = lu_decomposition_blocked(A, block_size)
+        row_indices_blocked = pivots_to_row_indices(pivots_blocked)
+        np.testing.assert_almost_equal(calculate_L_mult_U(LU_blocked),  A[row_indices_blocked])
+
+# factor once, solve many times
+cache = LUCache()
+for repeat in range(3):
+    for A in As:
+        b = np.random.rand(len(A), 2)
+        np.testing.assert_almost_equal(cache.solve(A, b), scipy.linalg.solve(A, b))
+assert cache.misses == len(As) and cache.hits == 2 * len(As)
+
+# a cache with room for a single 6x6 factorization only keeps the last one
+cache = LUCache(max_bytes=LUFactorization(As[-1]).nbytes)
+for A in As:
+    cache.factorize(A)
+assert len(cache.factorizations) == 1 and cache.nbytes <= cache.max_bytes
+
+# single precision factors with iterative refinement
+A = random_non_singular_matrix(200) + 10 * np.eye(200)
+b = np.random.rand(200)
+x, iterations, fallback = solve_mixed_precision(A, b)
+print('mixed precision solve took', iterations, 'refinement steps')
+assert not fallback
+x_scipy = scipy.linalg.solve(A, b)
+assert np.linalg.norm(x - x_scipy) < 1e-12 * np.linalg.norm(x_scipy)
+
+# running out of refinement steps falls back to double precision, and the
+# steps taken are counted exactly
+A = random_non_singular_matrix(50) + 10 * np.eye(50)
+b = np.random.rand(50)
+for max_iter in [0, 1, 3]:
+    x, iterations, fallback = solve_mixed_precision(A, b, tol=1e-30, max_iter=max_iter)
+    assert fallback and iterations == max_iter
+    np.testing.assert_allclose(x, scipy.linalg.solve(A, b))
+
+# the Hilbert matrix is too ill-conditioned for single precision factors
+A = scipy.linalg.hilbert(6)
+b = np.random.rand(6)
+x, iterations, fallback = solve_mixed_precision(A, b)
+assert fallback
+np.testing.assert_allclose(x, scipy.linalg.solve(A, b), rtol=1e-6)
+
+A_batch = np.array([random_non_singular_matrix(5) for i in range(10)])
+A_batch[7, 2, :] = 0
+LU_batch, pivots_batch, singular = lu_decomposition(A_batch)
+np.testing.assert_equal(singular, np.arange(10) == 7)
+for A, LU, pivots in zip(A_batch, LU_batch, pivots_batch):
+    np.testing.assert_almost_equal(calculate_L_mult_U(LU), A[pivots_to_row_indices(pivots)])
+
+# the batched and the single matrix factorizations pick the same pivots,
+# here the largest magnitude entry of the first column is negative
+A_negative = np.array(A_batch[~singular])
+A_negative[:, 3, 0] = -10
+LU_negative, pivots_negative, _ = lu_decomposition(A_negative)
+for A, LU, pivots in zip(A_negative, LU_negative, pivots_negative):
+    LU_looped, pivots_looped = lu_decomposition(A)
+    np.testing.assert_equal(pivots, pivots_looped)
+    np.testing.assert_almost_equal(LU, LU_looped)
+
+# and the factors of the whole stack solve through the batched triangular solves
+b_batch = np.random.rand(10, 5)
+rows = np.array([pivots_to_row_indices(pivots) for pivots in pivots_batch])
+y_batch = solve_triangular(LU_batch, np.take_along_axis(b_batch, rows, axis=1),
+                           lower=True, unit_diagonal=True)
+x_batch = solve_triangular(LU_batch, y_batch)
+for A, b, x in zip(A_batch[~singular], b_batch[~singular], x_batch[~singular]):
+    np.testing.assert_almost_equal(scipy.linalg.solve(A, b), x)
+
+# benchmark blocked LU against scipy (LAPACK getrf)
+Ns = 2**np.arange(6, 13)
+times = np.empty((len(Ns), 3), dtype=float)
+times[:] = np.nan
+for i, N in enumerate(Ns):
+    A = np.random.rand(N, N)
+
+    t0 = time.perf_counter()
+    scipy.linalg.lu_factor(A)
+    t1 = time.perf_counter()
+    times[i, 0] = t1 - t0
+
+    t0 = time.perf_counter()
+    LU_blocked, pivots_blocked = lu_decomposition_blocked(A)
+    t1 = time.perf_counter()
+    times[i, 1] = t1 - t0
+
+    if N <= 128:
+        t0 = time.perf_counter()
+        lu_decomposition(A)
+        t1 = time.perf_counter()
+        times[i, 2] = t1 - t0
+
+    if N <= 1024:
+        row_indices_blocked = pivots_to_row_indices(pivots_blocked)
+        np.testing.assert_allclose(calculate_L_mult_U(LU_blocked),
+                                   A[row_indices_blocked], atol=1e-8)
+
+plt.loglog(Ns, times)
+plt.xlabel('n')
+plt.ylabel('time taken')
+plt.legend(['scipy lu_factor', 'blocked LU', 'unblocked LU'])
+plt.show()
@@ -2,6 +2,11 @@ import numpy as np
 import matplotlib.pylab as plt
 import scipy
 import scipy.linalg
+import os
+import warnings
+import multiprocessing
+import concurrent.futures
+from sweep import limit_blas_threads, warn_unlimited_blas_threads
 
 n = 100
 xs = np.arange(0, n)
@@ -13,7 +18,95 @@ def construct_covariance(sigma1, sigma2):
     K += 1e-5 * np.eye(n)
     return K
 
-def sample_zero_mean_random_field(covariance_matrix):
+# On an evenly spaced grid the covariance is a symmetric Toeplitz matrix, so
+# it is fully described by its first column c
+def is_regular_grid(xs):
+    dx = np.diff(xs)
+    return len(dx) == 0 or np.allclose(dx, dx[0])
+
+def is_toeplitz(K):
+    # every diagonal is constant, and the matrix is symmetric
+    return np.array_equal(K[1:, 1:], K[:-1, :-1]) and np.array_equal(K[0], K[:, 0])
+
+def construct_covariance_column(sigma1, sigma2, xs=xs):
+    c = sigma1**2 * np.exp(-(xs - xs[0])**2 / sigma2**2)
+    c[0] += 1e-5
+    return c
+
+def extend_covariance_column(sigma1, sigma2, xs=xs):
+    # the covariance column continued past the end of the evenly spaced grid
+    # xs, as a function of the number of entries, for padding the embedding
+    dx = xs[1] - xs[0] if len(xs) > 1 else 1
+    return lambda size: construct_covariance_column(sigma1, sigma2, xs[0] + dx * np.arange(size))
+
+def circulant_embedding(c, extend=None, max_size=2**24):
+    # circulant embedding: the Toeplitz matrix is the top left block of a
+    # circulant matrix of size m, which is diagonalised by the FFT. The
+    # smallest embedding, m = 2(n - 1), can have negative eigenvalues, and
+    # is then padded with the column continued by extend(size) to the next
+    # powers of two, up to max_size. Returns the eigenvalues, or None if no
+    # embedding is nonnegative definite (to round-off)
+    n = len(c)
+    m = 2 * (n - 1)
+    while True:
+        if m > 2 * (n - 1):
+            c = extend(m // 2 + 1)
+        eigenvalues = np.fft.rfft(np.concatenate((c, c[-2:0:-1]))).real
+        if eigenvalues.min() >= -1e-12 * eigenvalues.max():
+            return np.concatenate((eigenvalues, eigenvalues[-2:0:-1]))
+        m = 2**int(np.ceil(np.log2(m + 1)))
+        if extend is None or m > max_size:
+            return None
+
+def sample_zero_mean_random_field_toeplitz(c, extend=None, max_size=2**24):
+    n = len(c)
+    if n == 1:
+        return np.sqrt(c) * np.random.normal(size=1)
+    eigenvalues = circulant_embedding(c, extend, max_size)
+    if eigenvalues is None:
+        warnings.warn('no nonnegative definite circulant embedding was found, '
+                      'sampling through the dense Cholesky factor instead')
+        L = scipy.linalg.cholesky(scipy.linalg.toeplitz(c), lower=True)
+        return L @ np.random.normal(size=n)
+    m = len(eigenvalues)
+    # only round-off is left to clip
+    eigenvalues = np.maximum(eigenvalues, 0)
+    indep_random_sample = np.random.normal(size=m) + 1j * np.random.normal(size=m)
+    return np.fft.fft(np.sqrt(eigenvalues / m) * indep_random_sample).real[:n]
+
+def toeplitz_logdet(c):
+    # Durbin's algorithm for the Yule-Walker equations: beta is the ratio of
+    # the determinants of successive leading blocks of the normalised matrix
+    n = len(c)
+    if n == 1:
+        return np.log(c[0])
+    r = c[1:] / c[0]
+    logdet = n * np.log(c[0])
+    y = np.empty(n - 1)
+    y[0] = alpha = -r[0]
+    beta = 1.0
+    for k in range(1, n - 1):
+        beta *= 1 - alpha**2
+        logdet += np.log(beta)
+        alpha = -(r[k] + r[k-1::-1] @ y[:k]) / beta
+        y[:k] = y[:k] + alpha * y[k-1::-1]
+        y[k] = alpha
+    beta *= 1 - alpha**2
+    return logdet + np.log(beta)
+
+def log_likelihood_toeplitz(sigma1, sigma2, x, xs=xs):
+    c = construct_covariance_column(sigma1, sigma2, xs)
+    logdet = toeplitz_logdet(c)
+    # scipy uses Levinson recursion, O(n^2) like the log-determinant above
+    xinvSx = x.dot(scipy.linalg.solve_toeplitz(c, x))
+
+    return -0.5 * (logdet + xinvSx)
+
+def sample_zero_mean_random_field(covariance_matrix, extend=None):
+    # a Toeplitz covariance on an evenly spaced grid is sampled through the
+    # FFT instead, by circulant embedding, padded using extend if given
+    if is_regular_grid(xs) and is_toeplitz(covariance_matrix):
+        return sample_zero_mean_random_field_toeplitz(covariance_matrix[:, 0], extend)
     L, _ = scipy.linalg.cho_factor(covariance_matrix, lower=True)
     indep_random_sample = np.random.normal(size=n)
     return np.dot(np.tril(L), indep_random_sample)
@@ -27,7 +120,36 @@ plt.plot(sample_zero_mean_random_field(K1))
 plt.plot(sample_zero_mean_random_field(K2))
 plt.show()
 
+class RandomFieldGenerator:
+    # factor the covariance once, then draw blocks of samples with a single
+    # matrix product each, or iterate to stream batches of batch_size samples
+    def __init__(self, covariance_matrix, batch_size=1000, seed=None):
+        self.L = scipy.linalg.cholesky(covariance_matrix, lower=True)
+        self.batch_size = batch_size
+        self.rng = np.random.default_rng(seed)
+
+    def sample(self, m=1):
+        indep_random_samples = self.rng.standard_normal((len(self.L), m))
+        return self.L @ indep_random_samples
+
+    def __iter__(self):
+        while True:
+            yield self.sample(self.batch_size)
+
+generator = RandomFieldGenerator(K2, batch_size=5, seed=1)
+np.testing.assert_allclose(generator.L @ generator.L.T, K2)
+np.testing.assert_equal(RandomFieldGenerator(K2, seed=1).sample(5), next(iter(generator)))
+plt.clf()
+plt.plot(generator.sample(5))
+plt.show()
+
 def log_likelihood(sigma1, sigma2, x):
+    # the O(n^2) Toeplitz version on an evenly spaced grid
+    if is_regular_grid(xs):
+        return log_likelihood_toeplitz(sigma1, sigma2, x)
+    return log_likelihood_cholesky(sigma1, sigma2, x)
+
+def log_likelihood_cholesky(sigma1, sigma2, x):
     K = construct_covariance(sigma1, sigma2)
     L, lower = scipy.linalg.cho_factor(K, lower=True)
 
@@ -36,12 +158,79 @@ def log_likelihood(sigma1, sigma2, x):
 
     return -0.5 * (logdet + xinvSx)
 
+# Evaluate the log-likelihood over a whole grid of hyperparameters. The
+# squared distances are computed once, and each chunk of grid points builds
+# a stack of covariance matrices and factors them in one batched call.
+worker_data = {}
+
+def init_worker(sq_dist, x, blas_threads):
+    worker_data['sq_dist'] = sq_dist
+    worker_data['x'] = x
+    if blas_threads is not None:
+        worker_data['limits'] = limit_blas_threads(blas_threads)
+
+def log_likelihood_chunk(sigma1, sigma2):
+    sq_dist = worker_data['sq_dist']
+    x = worker_data['x']
+    diag = np.arange(len(x))
+    K = np.multiply.outer(-1 / sigma2**2, sq_dist)
+    np.exp(K, out=K)
+    K *= sigma1[:, np.newaxis, np.newaxis]**2
+    K[:, diag, diag] += 1e-5
+    L = np.linalg.cholesky(K)
+
+    logdet = 2 * np.sum(np.log(L[:, diag, diag]), axis=1)
+    y = scipy.linalg.solve_triangular(
+        L, np.broadcast_to(x[:, np.newaxis], (len(K), len(x), 1)), lower=True
+    )
+    xinvSx = np.sum(y**2, axis=(1, 2))
+
+    return -0.5 * (logdet + xinvSx)
+
+def log_likelihood_grid(Sigma1, Sigma2, x, chunk_size=100, max_workers=None):
+    sq_dist = (xs[:, np.newaxis] - xs[np.newaxis, :])**2
+    sigma1 = Sigma1.ravel()
+    sigma2 = Sigma2.ravel()
+    chunks = range(0, len(sigma1), chunk_size)
+    L = np.empty(Sigma1.shape)
+
+    if max_workers is None:
+        max_workers = os.cpu_count()
+    # workers are forked, as spawning them would re-run this whole script
+    if max_workers == 1 or 'fork' not in multiprocessing.get_all_start_methods():
+        init_worker(sq_dist, x, None)
+        for i in chunks:
+            L.flat[i:i+chunk_size] = log_likelihood_chunk(sigma1[i:i+chunk_size],
+                                                          sigma2[i:i+chunk_size])
+        return L
+
+    blas_threads = max(1, os.cpu_count() // max_workers)
+    warn_unlimited_blas_threads(blas_threads)
+    with concurrent.futures.ProcessPoolExecutor(
+        max_workers, mp_context=multiprocessing.get_context('fork'),
+        initializer=init_worker, initargs=(sq_dist, x, blas_threads)
+    ) as pool:
+        futures = {
+            pool.submit(log_likelihood_chunk, sigma1[i:i+chunk_size],
+                        sigma2[i:i+chunk_size]): i
+            for i in chunks
+        }
+        # write each chunk into the output as soon as it is finished
+        for future in concurrent.futures.as_completed(futures):
+            i = futures[future]
+            L.flat[i:i+chunk_size] = future.result()
+    return L
+
 sigma1 = np.linspace(0.5, 1.5, 100)
 sigma2 = np.linspace(5.0, 15.0, 100)
 Sigma1, Sigma2 = np.meshgrid(sigma1, sigma2)
 x = sample_zero_mean_random_field(K2)
 
-L = np.vectorize(log_likelihood, excluded=['x'])(Sigma1, Sigma2, x=x)
+L = log_likelihood_grid(Sigma1, Sigma2, x)
+np.testing.assert_allclose(
+    L[::10, ::10],
+    np.vectorize(log_likelihood_cholesky, excluded=['x'])(Sigma1[::10, ::10], Sigma2[::10, ::10], x=x)
+)
 max_log_likelihood = log_likelihood(1, 10, x)
 levels = np.linspace(0.9 * max_log_likelihood, max_log_likelihood, 5)
 
@@ -57,3 +246,47 @@ plt.xlabel(r'$\sigma_1$')
 plt.ylabel(r'$\sigma_2$')
 plt.show()
 
+# the Toeplitz versions agree with the dense Cholesky versions
+assert is_regular_grid(xs)
+c = construct_covariance_column(1.0, 10.0)
+np.testing.assert_allclose(scipy.linalg.toeplitz(c), construct_covariance(1.0, 10.0))
+for s1, s2 in [(1.0, 10.0), (0.5, 5.0), (1.5, 15.0)]:
+    np.testing.assert_allclose(log_likelihood_toeplitz(s1, s2, x),
+                               log_likelihood_cholesky(s1, s2, x), rtol=1e-6)
+    assert log_likelihood(s1, s2, x) == log_likelihood_toeplitz(s1, s2, x)
+assert is_toeplitz(K1) and is_toeplitz(K2) and not is_toeplitz(generator.L)
+
+# grids with one or two points
+assert is_regular_grid(xs[:1]) and is_regular_grid(xs[:0])
+for m in [1, 2]:
+    c = construct_covariance_column(1.0, 10.0, xs[:m])
+    np.testing.assert_allclose(toeplitz_logdet(c),
+                               np.linalg.slogdet(scipy.linalg.toeplitz(c))[1])
+    assert sample_zero_mean_random_field_toeplitz(c).shape == (m,)
+
+# a long correlation length needs a padded embedding, and without the
+# continued column the sampler falls back to the dense Cholesky factor. The
+# sample covariance matches the Toeplitz matrix either way
+c = construct_covariance_column(1.0, 100.0)
+extend = extend_covariance_column(1.0, 100.0)
+assert circulant_embedding(c) is None
+assert len(circulant_embedding(c, extend)) > 2 * (n - 1)
+with warnings.catch_warnings(record=True) as caught:
+    warnings.simplefilter('always')
+    padded = np.array([sample_zero_mean_random_field_toeplitz(c, extend) for i in range(20000)])
+    assert not caught
+    dense = np.array([sample_zero_mean_random_field_toeplitz(c) for i in range(20000)])
+    assert len(caught) == 20000
+for samples in [padded, dense]:
+    error = np.linalg.norm(samples.T @ samples / len(samples) - scipy.linalg.toeplitz(c))
+    assert error < 0.02 * np.linalg.norm(scipy.linalg.toeplitz(c))
+
+# circulant embedding makes very large random fields cheap
+big_xs = np.arange(0, 10**6)
+if is_regular_grid(big_xs):
+    plt.clf()
+    plt.plot(sample_zero_mean_random_field_toeplitz(
+        construct_covariance_column(1.0, 10.0, big_xs),
+        extend_covariance_column(1.0, 10.0, big_xs)
+    ))
+    plt.show()
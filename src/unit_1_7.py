@@ -2,10 +2,13 @@ import pandas as pd
 import matplotlib.pylab as plt
 import numpy as np
 import scipy.linalg
+import os
+import multiprocessing
+import concurrent.futures
 
 names = ['year', 'month', 'maxTemp', 'minTemp', 'hoursFrost', 'rain', 'hoursSun']
 df    = pd.read_csv('OxfordWeather.txt',
-                     delim_whitespace=True, header=None, names=names)
+                     sep=r'\s+', header=None, names=names)
 
 x = df.month.values.reshape(-1,1)
 y = df.hoursSun.values.reshape(-1,1)
@@ -26,6 +29,119 @@ np.testing.assert_almost_equal(
     beta, np.linalg.lstsq(M, y, rcond=None)[0]
 )
 
+# streaming least squares: read the data a chunk at a time, and keep only the
+# R factor of the augmented matrix [M y], so Q is never formed. Folding in a
+# chunk is a QR of the old R stacked on top of the new rows, after which
+# beta solves the triangular system R[:p, :p] beta = R[:p, p].
+def design_matrix(x):
+    return np.concatenate([np.ones_like(x), x, x**2], axis=1)
+
+def read_weather_chunks(filename, chunksize=100):
+    for chunk in pd.read_csv(filename, sep=r'\s+', header=None, names=names,
+                             chunksize=chunksize):
+        x = chunk.month.values.reshape(-1,1)
+        y = chunk.hoursSun.values.reshape(-1,1)
+        yield design_matrix(x), y
+
+def streaming_least_squares(chunks):
+    R = None
+    for M_chunk, y_chunk in chunks:
+        rows = np.concatenate([M_chunk, y_chunk], axis=1)
+        if R is not None:
+            rows = np.concatenate([R, rows], axis=0)
+        R = np.linalg.qr(rows, mode='r')
+        p = M_chunk.shape[1]
+        if len(R) >= p:
+            yield scipy.linalg.solve_triangular(R[:p, :p], R[:p, p:])
+
+for beta_streaming in streaming_least_squares(read_weather_chunks('OxfordWeather.txt')):
+    pass
+np.testing.assert_almost_equal(beta_streaming, beta)
+
+# tall-skinny QR: factor blocks of rows independently (in parallel), then
+# combine pairs of the small R factors up a binary reduction tree. If Q is
+# needed, each block of Q is the block's own Q times the p x p pieces of the
+# tree Q factors on the path from that block to the root.
+worker_data = {}
+
+def qr_block(start, stop, compute_q):
+    block = worker_data['A'][start:stop]
+    if compute_q:
+        return np.linalg.qr(block, mode='reduced')
+    return None, np.linalg.qr(block, mode='r')
+
+def tsqr(A, n_blocks=None, max_workers=None, compute_q=False):
+    m, p = A.shape
+    if max_workers is None:
+        max_workers = os.cpu_count()
+    if n_blocks is None:
+        n_blocks = max_workers
+    n_blocks = max(1, min(n_blocks, m // p))
+    bounds = np.linspace(0, m, n_blocks + 1, dtype=int)
+    blocks = list(zip(bounds[:-1], bounds[1:], [compute_q] * n_blocks))
+
+    # the workers are forked, and so see A without it being sent to them
+    worker_data['A'] = A
+    if max_workers == 1 or 'fork' not in multiprocessing.get_all_start_methods():
+        factors = [qr_block(*block) for block in blocks]
+    else:
+        with concurrent.futures.ProcessPoolExecutor(
+            max_workers, mp_context=multiprocessing.get_context('fork')
+        ) as pool:
+            factors = list(pool.map(qr_block, *zip(*blocks)))
+    del worker_data['A']
+
+    Qs = [Q for Q, R in factors]
+    Rs = [R for Q, R in factors]
+    # each tree node remembers which blocks are below it
+    groups = [[i] for i in range(n_blocks)]
+    while len(Rs) > 1:
+        new_Rs = []
+        new_groups = []
+        for i in range(0, len(Rs) - 1, 2):
+            Q, R = np.linalg.qr(np.concatenate([Rs[i], Rs[i+1]], axis=0), mode='reduced')
+            if compute_q:
+                k = len(Rs[i])
+                for j in groups[i]:
+                    Qs[j] = Qs[j] @ Q[:k]
+                for j in groups[i+1]:
+                    Qs[j] = Qs[j] @ Q[k:]
+            new_Rs.append(R)
+            new_groups.append(groups[i] + groups[i+1])
+        if len(Rs) % 2 == 1:
+            new_Rs.append(Rs[-1])
+            new_groups.append(groups[-1])
+        Rs = new_Rs
+        groups = new_groups
+
+    if compute_q:
+        return np.concatenate(Qs, axis=0), Rs[0]
+    return Rs[0]
+
+def tsqr_least_squares(M, y, **kwargs):
+    # the R factor of [M y] contains Q^T y, so Q is never needed
+    p = M.shape[1]
+    R = tsqr(np.concatenate([M, y], axis=1), **kwargs)
+    return scipy.linalg.solve_triangular(R[:p, :p], R[:p, p:])
+
+Q_tsqr, R_tsqr = tsqr(M, n_blocks=5, compute_q=True)
+np.testing.assert_almost_equal(Q_tsqr @ R_tsqr, M)
+np.testing.assert_almost_equal(
+    np.linalg.solve(R_tsqr, Q_tsqr.T @ y), np.linalg.lstsq(M, y, rcond=None)[0]
+)
+np.testing.assert_almost_equal(
+    tsqr_least_squares(M, y, n_blocks=7), np.linalg.lstsq(M, y, rcond=None)[0]
+)
+
+# a very tall, skinny design matrix
+x_tall = np.random.rand(10**6, 1) * 12
+y_tall = 2 + 3 * x_tall - 0.25 * x_tall**2 + np.random.normal(size=x_tall.shape)
+M_tall = design_matrix(x_tall)
+np.testing.assert_almost_equal(
+    tsqr_least_squares(M_tall, y_tall, n_blocks=64),
+    np.linalg.lstsq(M_tall, y_tall, rcond=None)[0]
+)
+
 plt.plot(x, y, 'o')
 plt.plot(x, M @ beta, 'r')
 plt.xlabel('month')
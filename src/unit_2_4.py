@@ -2,6 +2,48 @@ import scipy.sparse.linalg
 import scipy.sparse as sp
 import matplotlib.pylab as plt
 import numpy as np
+import scipy.linalg
+
+class BandedMatrix:
+    # only the diagonals are stored, in the (l + u + 1, N) layout used by
+    # LAPACK and scipy.linalg.solve_banded: ab[u + i - j, j] = A[i, j]
+    def __init__(self, ab, l, u):
+        self.ab = ab
+        self.l = l
+        self.u = u
+        self.shape = (ab.shape[1], ab.shape[1])
+
+    @classmethod
+    def from_sparse(cls, A):
+        A = A.todia()
+        l = max(0, -A.offsets.min())
+        u = max(0, A.offsets.max())
+        ab = np.zeros((l + u + 1, A.shape[1]))
+        for offset, diagonal in zip(A.offsets, A.data):
+            ab[u - offset] = diagonal[:A.shape[1]]
+        return cls(ab, l, u)
+
+    def solve(self, b):
+        # b can be (N,) or hold k right-hand sides as (N, k)
+        if self.l == 1 and self.u == 1:
+            # tridiagonal, use the LAPACK Thomas algorithm (with pivoting)
+            _, _, _, x, info = scipy.linalg.lapack.dgtsv(
+                self.ab[2, :-1], self.ab[1], self.ab[0, 1:], b.reshape(len(b), -1)
+            )
+            if info > 0:
+                raise np.linalg.LinAlgError(f'singular matrix: U[{info - 1}, {info - 1}] is exactly zero')
+            return x.reshape(b.shape)
+        return scipy.linalg.solve_banded((self.l, self.u), self.ab, b)
+
+def bandwidth(A):
+    A = A.tocoo()
+    return np.max(np.abs(A.row - A.col), initial=0)
+
+def solve(A, b, max_bandwidth=10):
+    # use the banded solver when all the nonzeros are close to the diagonal
+    if bandwidth(A) <= max_bandwidth:
+        return BandedMatrix.from_sparse(A).solve(b)
+    return sp.linalg.splu(A).solve(b)
 
 N = 100
 e = np.ones(N, dtype=float)
@@ -38,41 +80,88 @@ for f, a in zip([fcos, fsin], [analytical_cos, analytical_sin]):
     plt.legend()
     plt.show()
 
+# the banded solver does both problems in one call
+B = np.stack((fcos[1:-1], fsin[1:-1]), axis=1)
+B[0] -= np.array([analytical_cos[0], analytical_sin[0]]) / h**2
+B[-1] -= np.array([analytical_cos[-1], analytical_sin[-1]]) / h**2
+V = solve(A / h**2, B)
+np.testing.assert_almost_equal(V, splu.solve(B))
+
+# wider bands go through scipy.linalg.solve_banded
+A5 = sp.spdiags([e, 2*e, -6*e, 2*e, e], [-2, -1, 0, 1, 2], N, N, format='csc')
+np.testing.assert_almost_equal(solve(A5, B), sp.linalg.splu(A5).solve(B))
+
+# a singular tridiagonal matrix raises, like solve_banded does
+try:
+    BandedMatrix(np.array([[0., 1, 0], [1, 1, 1], [1, 0, 0]]), 1, 1).solve(np.ones(3))
+    assert False, 'singular matrix was not detected'
+except np.linalg.LinAlgError:
+    pass
+
 import time
-num = 100
-times = np.empty(num, dtype=float)
-times_dense = np.empty(num, dtype=float)
-times_dense[:] = np.nan
-Ns = np.logspace(0.5, 6, num=num, dtype=int)
-for i, N in enumerate(Ns):
+import json
+import sweep
+from sparse_kernels import ParallelCSR
+from measure import measure
+
+# an 8MB result is counted in the peak and is still allocated after the call
+_, stats = measure(np.ones, 10**6)
+assert stats['peak_traced_memory'] >= 8 * 10**6 and stats['retained_memory'] >= 8 * 10**6
+
+products = ['sparse', 'dense', 'parallel sparse']
+
+def product_cell(N, product):
     e = np.ones(N, dtype=float)
     A = sp.spdiags([e, -2*e, e], [-1, 0, 1], N, N, format='csc')
-
+    if product == 'dense':
+        A = A.toarray()
+    elif product == 'parallel sparse':
+        # the rows of A are split over threads, which each multiply by all of A
+        A = A.tocsr()
+        with ParallelCSR(A, min_nnz_per_thread=10000) as P:
+            t0 = time.perf_counter()
+            AA = P.matmul_sparse(A)
+            t1 = time.perf_counter()
+        assert abs(AA - A @ A).max() < 1e-10
+        return {'times': t1 - t0}
     t0 = time.perf_counter()
     AA = A @ A
     t1 = time.perf_counter()
-    times[i] = t1 - t0
+    return {'times': t1 - t0}
 
-    if N < 2000:
-        Adense = A.toarray()
-        t0 = time.perf_counter()
-        AA = Adense @ Adense
-        t1 = time.perf_counter()
-        times_dense[i] = t1 - t0
+num = 100
+times = np.empty((num, len(products)), dtype=float)
+times[:] = np.nan
+Ns = np.logspace(0.5, 6, num=num, dtype=int)
+cells = {
+    (i, k): (N, product)
+    for i, N in enumerate(Ns) for k, product in enumerate(products)
+    if product != 'dense' or N < 2000
+}
+# one cell at a time, so that the threads of the parallel product have all
+# the cores to themselves instead of competing with other workers
+sweep.run_sweep(product_cell, cells, outputs={'times': times},
+                checkpoint='unit_2_4_product_sweep.jsonl', timeout=600, max_workers=1)
+times, times_dense, times_parallel = times.T
 
 plt.clf()
 plt.loglog(Ns, times, label='sparse @')
 plt.loglog(Ns, times_dense, label='dense @')
+plt.loglog(Ns, times_parallel, label='parallel sparse @')
 plt.xlabel('N')
 plt.ylabel('time taken')
 plt.legend()
 plt.show()
 
-times = np.empty(num, dtype=float)
-times_dense = np.empty(num, dtype=float)
-times_dense[:] = np.nan
+def sparse_lu_solve(A, b):
+    splu = sp.linalg.splu(A)
+    return splu, splu.solve(b)
 
-for i, N in enumerate(Ns):
+def dense_lu_solve(A, b):
+    lu = scipy.linalg.lu_factor(A)
+    return lu, scipy.linalg.lu_solve(lu, b)
+
+def poisson_problem(N):
     e = np.ones(N, dtype=float)
     A = sp.spdiags([e, -2*e, e], [-1, 0, 1], N, N, format='csc')
 
@@ -82,27 +171,51 @@ for i, N in enumerate(Ns):
     analytical_cos = -np.sin(x) / np.exp(x)
 
     A /= h**2
+    ab = np.stack((e, -2*e, e)) / h**2
 
     b = fcos[1:-1]
     b[0] -= analytical_cos[0] / h**2
     b[-1] -= analytical_cos[-1] / h**2
-
-    t0 = time.perf_counter()
-    splu = sp.linalg.splu(A)
-    v = splu.solve(b)
-    t1 = time.perf_counter()
-    times[i] = t1 - t0
-    if N < 2000:
-        Adense = A.toarray()
-        t0 = time.perf_counter()
-        lu = scipy.linalg.lu_factor(Adense)
-        v = scipy.linalg.lu_solve(lu, b)
-        t1 = time.perf_counter()
-        times_dense[i] = t1 - t0
+    return A, ab, b
+
+solvers = ['sparse LU', 'dense LU', 'banded LU']
+
+def solver_cell(N, solver):
+    A, ab, b = poisson_problem(N)
+    if solver == 'sparse LU':
+        (splu, v), stats = measure(sparse_lu_solve, A, b)
+        factor_nnz = splu.L.nnz + splu.U.nnz
+    elif solver == 'dense LU':
+        (lu, v), stats = measure(dense_lu_solve, A.toarray(), b)
+        factor_nnz = lu[0].size
+    elif solver == 'banded LU':
+        v, stats = measure(BandedMatrix(ab, 1, 1).solve, b)
+        factor_nnz = ab.size
+        v_sparse = sp.linalg.splu(A).solve(b)
+        assert np.linalg.norm(v - v_sparse) < 1e-6 * np.linalg.norm(v_sparse)
+    return {'times': stats['time'],
+            'record': dict(solver=solver, N=int(N), factor_nnz=factor_nnz, **stats)}
+
+times = np.empty((num, len(solvers)), dtype=float)
+times[:] = np.nan
+cells = {
+    (i, k): (N, solver)
+    for i, N in enumerate(Ns) for k, solver in enumerate(solvers)
+    if solver != 'dense LU' or N < 2000
+}
+results = sweep.run_sweep(solver_cell, cells, outputs={'times': times},
+                          checkpoint='unit_2_4_solver_sweep.jsonl', timeout=600)
+times, times_dense, times_banded = times.T
+records = [results[index]['record'] for index in sorted(results)]
+
+# memory statistics, next to the timings
+with open('unit_2_4_memory.json', 'w') as file:
+    json.dump(records, file, indent=1)
 
 plt.clf()
 plt.loglog(Ns, times, label='sparse LU')
 plt.loglog(Ns, times_dense, label='dense LU')
+plt.loglog(Ns, times_banded, label='banded LU')
 plt.xlabel('N')
 plt.ylabel('time taken')
 plt.legend()
@@ -2,16 +2,24 @@ import numpy as np
 import scipy.sparse as sp
 import scipy.sparse.linalg
 import scipy.optimize
+import scipy.linalg
+import hashlib
+import time
+import weakref
+import collections
 import matplotlib.pylab as plt
+import sweep
+from sparse_kernels import ParallelCSR, LaplacianOperator
+from telemetry import SolverTelemetry
 
 def buildA(N):
     dx = 1 / N
     nvar = (N - 1)**2;
     e1 = np.ones((nvar), dtype=float);
     e2 = np.copy(e1)
-    e2[:N-1:] = 0
+    e2[::N-1] = 0
     e3 = np.copy(e1)
-    e3[N-2:N-1:] = 0
+    e3[N-2::N-1] = 0
     A = sp.spdiags(
         (-e1, -e3, 4*e1, -e2, -e1),
         (-(N-1), -1, 0, 1, N-1), nvar, nvar
@@ -32,7 +40,9 @@ def buildf2(N):
     f = np.dot(np.maximum(x,1-x), np.maximum(y,1-y))
     return f[1:,1:].reshape(-1, 1)
 
-def jacobi(A, b, x0=None, tol=1e-5, max_iter=1000):
+def jacobi(A, b, x0=None, tol=1e-5, max_iter=1000, telemetry=None):
+    if telemetry is None:
+        telemetry = SolverTelemetry(max_iter, enabled=False)
     if x0 is None:
         x0 = np.zeros_like(b)
     x = np.copy(x0)
@@ -43,15 +53,23 @@ def jacobi(A, b, x0=None, tol=1e-5, max_iter=1000):
     invM = 1/M
 
     # main relaxation iteration
+    reason = 'max_iter'
     for i in range(max_iter):
         r = b - A @ x
+        telemetry.matvecs += 1
         error = np.linalg.norm(r) / b_norm
+        telemetry.record(error)
         if error < tol:
+            reason = 'converged'
             break
         x += invM * r
+        telemetry.preconditioner_applies += 1
+    telemetry.finish(reason)
     return x, i
 
-def SOR(A, b, omega, x0=None, tol=1e-5, max_iter=300):
+def SOR(A, b, omega, x0=None, tol=1e-5, max_iter=300, telemetry=None):
+    if telemetry is None:
+        telemetry = SolverTelemetry(max_iter, enabled=False)
     if x0 is None:
         x0 = np.zeros_like(b)
     x = np.copy(x0)
@@ -63,27 +81,267 @@ def SOR(A, b, omega, x0=None, tol=1e-5, max_iter=300):
     M = (1/omega) * D + L
 
     # main relaxation iteration
+    reason = 'max_iter'
     for i in range(max_iter):
         r = b - A @ x
+        telemetry.matvecs += 1
         error = np.linalg.norm(r) / b_norm
+        telemetry.record(error)
         if error < tol:
+            reason = 'converged'
             break
         x += sp.linalg.spsolve_triangular(M, r)
+        telemetry.preconditioner_applies += 1
+    telemetry.finish(reason)
     return x, i
 
+def is_laplacian(A, N, scale):
+    # A is scale / N^2 times buildA(N), up to rounding
+    if A.shape != ((N - 1)**2, (N - 1)**2):
+        return False
+    if isinstance(A, LaplacianOperator):
+        return A.N == N
+    if not sp.issparse(A):
+        return False
+    difference = abs(sp.csr_matrix(A) - (scale / N**2) * buildA(N))
+    return difference.max() <= 1e-12 * abs(scale)
+
+def SOR_red_black(A, b, omega, x0=None, tol=1e-5, max_iter=300, check_every=10,
+                  telemetry=None):
+    # A must be the 5-point Laplacian from buildA (or LaplacianOperator). The
+    # red points (i + j even) only couple to black points (i + j odd) and vice
+    # versa, so each half sweep is a vectorised in-place update of one colour.
+    # omega = 1 gives Gauss-Seidel.
+    if telemetry is None:
+        telemetry = SolverTelemetry(max_iter, enabled=False)
+    N = int(round(np.sqrt(A.shape[0]))) + 1
+    scale = A.diagonal()[0] / 4
+    if not is_laplacian(A, N, scale):
+        raise ValueError('SOR_red_black only applies to a multiple of the 5-point Laplacian')
+    if x0 is None:
+        x0 = np.zeros_like(b)
+    # x is stored inside a grid padded with the zero boundary values
+    padded = np.zeros((N + 1, N + 1))
+    x = padded[1:-1, 1:-1]
+    x[:] = x0.reshape(N - 1, N - 1)
+    b_grid = b.reshape(N - 1, N - 1)
+    b_norm = np.linalg.norm(b)
+
+    # main relaxation iteration, checking the residual every check_every
+    # sweeps. The residual history is nan for the sweeps in between
+    reason = 'max_iter'
+    for i in range(max_iter):
+        error = np.nan
+        if i % check_every == 0:
+            r = b_grid - scale * (4 * x - padded[:-2, 1:-1] - padded[2:, 1:-1]
+                                  - padded[1:-1, :-2] - padded[1:-1, 2:])
+            telemetry.matvecs += 1
+            error = np.linalg.norm(r) / b_norm
+        telemetry.record(error)
+        if error < tol:
+            reason = 'converged'
+            break
+        # red points are (even, even) and (odd, odd), black the other two
+        for i0, j0 in ((0, 0), (1, 1), (0, 1), (1, 0)):
+            x_colour = padded[1+i0:N:2, 1+j0:N:2]
+            x_gauss_seidel = (
+                padded[i0:N-1:2, 1+j0:N:2] + padded[2+i0:N+1:2, 1+j0:N:2]
+                + padded[1+i0:N:2, j0:N-1:2] + padded[1+i0:N:2, 2+j0:N+1:2]
+                + b_grid[i0::2, j0::2] / scale
+            ) / 4
+            x_colour *= 1 - omega
+            x_colour += omega * x_gauss_seidel
+    telemetry.finish(reason)
+    return x.reshape(b.shape), i
+
+
+# eigenvalue estimates for choosing omega without the analytic formula, which
+# only exists for the model problem. The Jacobi iteration matrix is
+# B = I - D^{-1} A, and for a consistently ordered matrix (such as buildA)
+# the optimal SOR omega is 2 / (1 + sqrt(1 - rho(B)^2)).
+def lanczos_bounds(A, tol=1e-3, max_iter=None, check_every=10, seed=0):
+    # estimate the smallest and largest eigenvalues of the symmetric A from
+    # the Ritz values of a Lanczos tridiagonalisation, stopping once they
+    # change by less than tol (relative) over check_every steps
+    n = A.shape[0]
+    if max_iter is None:
+        max_iter = min(n, 1000)
+    alpha = np.zeros(max_iter)
+    beta = np.zeros(max_iter)
+    v = np.random.default_rng(seed).standard_normal(n)
+    v /= np.linalg.norm(v)
+    v_old = np.zeros(n)
+    bounds = np.array([np.inf, np.inf])
+    for k in range(max_iter):
+        w = A @ v
+        alpha[k] = v @ w
+        w -= alpha[k] * v
+        if k > 0:
+            w -= beta[k - 1] * v_old
+        beta[k] = np.linalg.norm(w)
+        # an invariant subspace has been found, so the Ritz values are exact
+        invariant = beta[k] <= 1e-12 * abs(alpha[k])
+        if invariant or (k + 1) % check_every == 0 or k == max_iter - 1:
+            ritz = scipy.linalg.eigh_tridiagonal(alpha[:k + 1], beta[:k], eigvals_only=True)
+            new_bounds = np.array([ritz[0], ritz[-1]])
+            converged = np.all(np.abs(new_bounds - bounds) <= tol * np.abs(new_bounds))
+            bounds = new_bounds
+            if invariant or converged:
+                break
+        v_old, v = v, w / beta[k]
+    return bounds[0], bounds[1], k + 1
+
+def arnoldi_radius(B, tol=1e-3):
+    # spectral radius of a nonsymmetric B from a few restarted Arnoldi
+    # iterations. Plain power iteration stalls here, as the largest
+    # eigenvalues of the jacobi matrix are nearly equal in magnitude
+    eigenvalue = sp.linalg.eigs(B, k=1, which='LM', tol=tol, return_eigenvectors=False)
+    return abs(eigenvalue[0])
+
+# estimates for the most recently used max_spectral_cache operators
+spectral_cache = collections.OrderedDict()
+max_spectral_cache = 64
+
+def operator_key(A):
+    # sparse matrices are keyed by their contents, other operators by identity.
+    # The entries of an operator keyed by identity are dropped when it is
+    # garbage collected, so its id cannot be reused by a new operator
+    if sp.issparse(A):
+        A = A.tocsr()
+        digest = hashlib.blake2b(digest_size=16)
+        for array in (A.indptr, A.indices, A.data):
+            digest.update(np.ascontiguousarray(array).tobytes())
+        return A.shape, digest.hexdigest()
+    key = (A.shape, id(A))
+    if not any(cached[1] == key for cached in spectral_cache):
+        weakref.finalize(A, forget_operator, key)
+    return key
+
+def forget_operator(key):
+    for kind in ['bounds', 'omega']:
+        spectral_cache.pop((kind, key), None)
+
+def cached_estimate(key, estimate):
+    if key in spectral_cache:
+        spectral_cache.move_to_end(key)
+    else:
+        spectral_cache[key] = estimate()
+        while len(spectral_cache) > max_spectral_cache:
+            spectral_cache.popitem(last=False)
+    return spectral_cache[key]
+
+def spectral_bounds(A, tol=1e-3):
+    # smallest and largest eigenvalues of D^{-1} A for a symmetric A, from
+    # Lanczos on the similar matrix D^{-1/2} A D^{-1/2}. The estimates lie
+    # inside the spectrum, and are cached for each operator
+    def estimate():
+        invsqrtD = 1 / np.sqrt(A.diagonal())
+        scaled = sp.linalg.LinearOperator(
+            A.shape, matvec=lambda x: invsqrtD * (A @ (invsqrtD * np.ravel(x))), dtype=float
+        )
+        lmin, lmax, iters = lanczos_bounds(scaled, tol)
+        return lmin, lmax
+    return cached_estimate(('bounds', operator_key(A)), estimate)
+
+def is_symmetric(A, seed=0):
+    if sp.issparse(A):
+        A = A.tocsr()
+        return abs(A - A.T).max() <= 1e-12 * abs(A).max()
+    # for other operators, x^T (A y) = y^T (A x) for random x and y
+    rng = np.random.default_rng(seed)
+    x = rng.standard_normal(A.shape[0])
+    y = rng.standard_normal(A.shape[1])
+    Ax = np.ravel(A @ x)
+    Ay = np.ravel(A @ y)
+    return abs(x @ Ay - y @ Ax) <= 1e-10 * np.linalg.norm(x) * np.linalg.norm(Ay)
+
+def optimal_omega(A, tol=1e-3):
+    def estimate():
+        if is_symmetric(A):
+            lmin, lmax = spectral_bounds(A, tol)
+            rho = max(1 - lmin, lmax - 1)
+        else:
+            invD = 1 / A.diagonal()
+            B = sp.linalg.LinearOperator(A.shape, matvec=lambda x: np.ravel(x) - invD * (A @ np.ravel(x)),
+                                         dtype=float)
+            rho = arnoldi_radius(B, tol)
+        # there is no optimal omega to predict if jacobi does not converge
+        return 2 / (1 + np.sqrt(1 - rho**2)) if rho < 1 else 1.0
+    return cached_estimate(('omega', operator_key(A)), estimate)
+
+def chebyshev(A, b, x0=None, tol=1e-5, max_iter=1000, check_every=10, bounds=None,
+              telemetry=None):
+    # Chebyshev semi-iteration with a jacobi preconditioner, for symmetric A.
+    # The eigenvalue bounds of D^{-1} A take the place of the inner products
+    # in cg, and only the residual check (every check_every iterations)
+    # needs a norm
+    if telemetry is None:
+        telemetry = SolverTelemetry(max_iter, enabled=False)
+    if bounds is None:
+        bounds = spectral_bounds(A)
+    lmin, lmax = bounds
+    # Ritz values lie inside the spectrum, and eigenvalues above lmax would be
+    # amplified rather than damped, so the upper bound is widened a little
+    lmax *= 1.01
+    theta = (lmax + lmin) / 2
+    delta = (lmax - lmin) / 2
+    sigma = theta / delta
+    rho = 1 / sigma
+
+    b = np.asarray(b, dtype=float)
+    x = np.zeros_like(b) if x0 is None else np.array(x0, dtype=float)
+    invD = (1 / A.diagonal()).reshape((-1,) + (1,) * (b.ndim - 1))
+    b_norm = np.linalg.norm(b)
+    r = b - A @ x
+    telemetry.matvecs += 1
+    d = invD * r / theta
+    telemetry.preconditioner_applies += 1
+
+    reason = 'max_iter'
+    for i in range(max_iter):
+        error = np.nan
+        if i % check_every == 0:
+            error = np.linalg.norm(r) / b_norm
+        telemetry.record(error)
+        if error < tol:
+            reason = 'converged'
+            break
+        x += d
+        r -= A @ d
+        telemetry.matvecs += 1
+        rho_new = 1 / (2 * sigma - rho)
+        d *= rho_new * rho
+        d += 2 * rho_new / delta * (invD * r)
+        telemetry.preconditioner_applies += 1
+        rho = rho_new
+    telemetry.finish(reason)
+    return x, i
+
+def jacobi_cell(j, N):
+    A = buildA(N)
+    f = (buildf1, buildf2)[j](N)
+    max_iter = 10*N
+    x, iters = jacobi(A, f, max_iter=max_iter)
+    return {'iterations': iters}
 
 num = 20
-iterations = np.empty((num, 2), dtype=int)
+iterations = np.empty((num, 2), dtype=float)
 iterations[:] = np.nan
 Ns = np.logspace(0.5, 1.5, num=num, dtype=int)
-for j, buildf in enumerate((buildf1, buildf2)):
-    for i, N in enumerate(Ns):
-        A = buildA(N)
-        f = buildf(N)
-        max_iter = 10*N
-        x, iters = jacobi(A, f, max_iter=max_iter)
-        if i < max_iter:
-            iterations[i, j] = iters
+cells = {(i, j): (j, N) for j in range(2) for i, N in enumerate(Ns)}
+sweep.run_sweep(jacobi_cell, cells, outputs={'iterations': iterations},
+                checkpoint='unit_2_6_sweep.jsonl', timeout=600)
+
+# jacobi only needs A @ x and the diagonal, so it also works matrix-free
+N = 16
+x, iters = jacobi(buildA(N), buildf2(N), max_iter=10*N)
+x_matrix_free, iters_matrix_free = jacobi(LaplacianOperator(N), buildf2(N), max_iter=10*N)
+np.testing.assert_allclose(x_matrix_free, x)
+assert iters_matrix_free == iters
+# as does the multithreaded CSR operator
+with ParallelCSR(buildA(N), min_nnz_per_thread=100) as A_parallel:
+    x_parallel, iters_parallel = jacobi(A_parallel, buildf2(N), max_iter=10*N)
+np.testing.assert_allclose(x_parallel, x)
 
 plt.plot(Ns, iterations)
 plt.xlabel('N')
@@ -94,11 +352,93 @@ N = 64
 A = buildA(N)
 f = buildf2(N)
 
+# red-black SOR and Gauss-Seidel converge to the same solution as SOR
+x_exact = sp.linalg.spsolve(A.tocsr(), f).reshape(-1, 1)
+x, iters = SOR(A, f, 1.9, tol=1e-8, max_iter=1000)
+x_red_black, iters_red_black = SOR_red_black(A, f, 1.9, tol=1e-8, max_iter=1000, check_every=1)
+np.testing.assert_allclose(x_red_black, x_exact, rtol=1e-5)
+x_gauss_seidel, iters_gauss_seidel = SOR_red_black(A, f, 1.0, tol=1e-8, max_iter=100000)
+np.testing.assert_allclose(x_gauss_seidel, x_exact, rtol=1e-5)
+print('SOR iterations', iters, 'red-black SOR iterations', iters_red_black,
+      'red-black Gauss-Seidel iterations', iters_gauss_seidel)
+
+# only the stencil of the Laplacian is used, so other matrices are rejected
+x_free, _ = SOR_red_black(LaplacianOperator(N), f, 1.9, tol=1e-8, max_iter=1000, check_every=1)
+np.testing.assert_allclose(x_free, x_red_black)
+try:
+    SOR_red_black(A + sp.eye(A.shape[0]), f, 1.9)
+    assert False, 'SOR_red_black accepted a matrix that is not the Laplacian'
+except ValueError:
+    pass
+
+# the telemetry records the residual at every check, and how long it took
+jacobi_telemetry = SolverTelemetry(max_iter=1000, solver='jacobi', N=int(N))
+jacobi(A, f, max_iter=1000, telemetry=jacobi_telemetry)
+red_black_telemetry = SolverTelemetry(max_iter=1000, solver='red-black SOR', N=int(N))
+SOR_red_black(A, f, 1.9, tol=1e-8, max_iter=1000, check_every=1, telemetry=red_black_telemetry)
+assert jacobi_telemetry.reason == 'max_iter' and red_black_telemetry.reason == 'converged'
+assert red_black_telemetry.iterations == iters_red_black + 1
+assert red_black_telemetry.residuals[-1] < 1e-8
+plt.semilogy(jacobi_telemetry.residuals, label='jacobi')
+plt.semilogy(red_black_telemetry.residuals, label='red-black SOR')
+plt.xlabel('iteration')
+plt.ylabel('relative residual')
+plt.legend()
+plt.show()
+print('red-black SOR took', red_black_telemetry.total_time, 'seconds,',
+      np.median(red_black_telemetry.iteration_times), 'per iteration')
+
+# red-black sweeps are cheap enough to minimise the actual number of
+# iterations needed, rather than the residual after a few iterations
 def SOR_iterations(omega):
-    x, i = SOR(A, f, omega, max_iter=10, tol=1e-32)
-    return np.linalg.norm(A @ x - f)
+    x, i = SOR_red_black(A, f, omega, tol=1e-6, max_iter=5000, check_every=1)
+    return i
 
-res = scipy.optimize.minimize_scalar(SOR_iterations, bracket=[0.1, 1.0, 1.99], tol=1e-2)
+res = scipy.optimize.minimize_scalar(SOR_iterations, bounds=(1.0, 1.99), method='bounded',
+                                     options={'xatol': 1e-3})
 print('ideal omega is', res.x, 'versus analytic value of', 2 / (1 + np.sin(np.pi/N)))
 
+# a few Lanczos iterations predict the asymptotically optimal omega at a
+# fraction of the cost of the minimisation. The minimised omega is a little
+# larger, as it also accounts for the initial transient with this f
+t0 = time.perf_counter()
+omega = optimal_omega(A)
+t1 = time.perf_counter()
+print('estimated omega is', omega, 'in', t1 - t0, 'seconds, needing', SOR_iterations(omega),
+      'iterations versus', SOR_iterations(res.x), 'for the minimised omega')
+np.testing.assert_allclose(omega, 2 / (1 + np.sin(np.pi/N)), rtol=1e-3)
+assert SOR_iterations(omega) <= 1.15 * SOR_iterations(res.x)
+# the estimate is cached, and also works for the matrix-free operator
+cache_size = len(spectral_cache)
+assert optimal_omega(A) == omega and len(spectral_cache) == cache_size
+np.testing.assert_allclose(optimal_omega(LaplacianOperator(N)), omega, rtol=1e-3)
+# the matrix-free operator was garbage collected, so its estimates are gone
+assert len(spectral_cache) == cache_size
+# symmetry of a matrix-free operator is checked with random vectors
+assert is_symmetric(LaplacianOperator(N))
+assert not is_symmetric(sp.linalg.aslinearoperator(A + sp.eye(A.shape[0], k=1)))
+
+# a nonsymmetric (upwind) convection-diffusion matrix uses Arnoldi on the
+# jacobi iteration matrix instead
+S = sp.diags(-A.diagonal(-1) / N**2, -1)
+A_convection = (A + 20 * N * (sp.eye(A.shape[0]) - S)).tocsr()
+omega_convection = optimal_omega(A_convection)
+iters_convection = {
+    w: SOR(A_convection, f, w, tol=1e-6, max_iter=5000)[1]
+    for w in [1.5, omega_convection, 1.9]
+}
+print('convection-diffusion: iterations for omega =', iters_convection)
+assert iters_convection[omega_convection] == min(iters_convection.values())
+
+# Chebyshev iteration uses the same bounds, and needs no inner products
+x_exact = sp.linalg.spsolve(A.tocsr(), f).reshape(-1, 1)
+chebyshev_telemetry = SolverTelemetry(max_iter=1000, solver='chebyshev', N=int(N))
+x_chebyshev, iters_chebyshev = chebyshev(A, f, tol=1e-8, check_every=1, telemetry=chebyshev_telemetry)
+np.testing.assert_allclose(x_chebyshev, x_exact, rtol=1e-5)
+assert chebyshev_telemetry.reason == 'converged'
+cg_telemetry = SolverTelemetry(enabled=False)
+sp.linalg.cg(A, f, rtol=1e-8, M=sp.diags(1 / A.diagonal()), callback=lambda xk: cg_telemetry.record())
+print('chebyshev iterations', iters_chebyshev, 'versus jacobi preconditioned cg',
+      cg_telemetry.iterations)
+
 
@@ -1,9 +1,25 @@
 import numpy as np
 import scipy.sparse as sp
 import scipy.sparse.linalg
+import scipy.sparse.csgraph
+import scipy.linalg
+import scipy.linalg.lapack
+import scipy.linalg.blas
 import scipy.optimize
+import scipy.fft
 import matplotlib.pylab as plt
 import time
+import json
+import os
+import hashlib
+import logging
+import collections
+import concurrent.futures
+import sweep
+import disk_cache
+from sparse_kernels import ParallelCSR, LaplacianOperator
+from measure import measure
+from telemetry import SolverTelemetry, JsonLinesExporter, reason_from_info
 
 def buildA(N):
     dx = 1 / N
@@ -20,7 +36,6 @@ def buildA(N):
     A = A / dx**2;
     return A
 
-
 def buildf1(N):
     x = np.arange(0, 1, 1/N).reshape(N, 1)
     y = x.T
@@ -33,80 +48,1015 @@ def buildf2(N):
     f = np.dot(np.maximum(x,1-x), np.maximum(y,1-y))
     return f[1:,1:].reshape(-1, 1)
 
+# the matrix-free operator matches buildA
+for N in [3, 4, 10]:
+    A = buildA(N)
+    A_free = LaplacianOperator(N)
+    x = np.random.rand((N - 1)**2, 1)
+    np.testing.assert_allclose(A_free @ x, A @ x)
+    np.testing.assert_allclose(A_free.T @ x, A.T @ x)
+    np.testing.assert_allclose(A_free.diagonal(), A.diagonal())
+
+# its matvecs, as called by the Krylov solvers, write into preallocated
+# buffers, and solvers holding on to two products still converge
+N = 200
+A_free = LaplacianOperator(N)
+x = np.random.rand((N - 1)**2)
+_, stats = measure(A_free.matvec, x)
+assert stats['peak_traced_memory'] < x.nbytes / 10
+f = buildf1(N).ravel()
+for method in [sp.linalg.cg, sp.linalg.bicgstab]:
+    x, info = method(A_free, f, rtol=1e-8)
+    assert info == 0 and np.linalg.norm(buildA(N) @ x - f) < 1e-6 * np.linalg.norm(f)
+
+def lu_solve(A, f):
+    lu_A = scipy.linalg.lu_factor(A)
+    return lu_A, scipy.linalg.lu_solve(lu_A, f)
+
+def cho_solve(A, f):
+    cho_A = scipy.linalg.cho_factor(A.toarray())
+    return cho_A, scipy.linalg.cho_solve(cho_A, f)
+
+def inv_solve(A, f):
+    invA = scipy.linalg.inv(A)
+    return invA, invA @ f
+
+def krylov_solve(solver, A, f, M=None, telemetry=None, **kwargs):
+    if telemetry is None:
+        telemetry = SolverTelemetry(enabled=False)
+    # true relative residuals use A directly, so they are not counted as
+    # matvecs of the solver
+    f_norm = np.linalg.norm(f)
+    true_residual = lambda xk: np.linalg.norm(np.ravel(f) - A @ np.ravel(xk)) / f_norm
+    if solver is sp.linalg.gmres:
+        # gmres passes the norm of its preconditioned residual to the callback
+        kwargs['callback_type'] = 'pr_norm'
+        telemetry.residual_type = 'preconditioned'
+        callback = telemetry.record
+    elif telemetry.enabled:
+        # cg and bicgstab pass the iterate, so recompute the residual
+        callback = lambda xk: telemetry.record(true_residual(xk))
+    else:
+        callback = lambda xk: telemetry.record()
+    x, info = solver(telemetry.count_matvecs(A), f,
+                     M=telemetry.count_preconditioner_applies(M),
+                     callback=callback, **kwargs)
+    # the callbacks may not see the returned x (e.g. bicgstab's last half step)
+    telemetry.finish(reason_from_info(info),
+                     true_residual(x) if telemetry.enabled else np.nan)
+    return x, telemetry.iterations
+
+# preconditioners for the Krylov solvers. Each builder takes the matrix and
+# returns a LinearOperator approximating A^{-1}, to be passed in as M=
+def jacobi_preconditioner(A):
+    invD = 1 / A.diagonal()
+    return sp.linalg.LinearOperator(A.shape, matvec=lambda r: invD * np.ravel(r))
+
+def ssor_preconditioner(A, omega=1.5):
+    # M = omega / (2 - omega) (D/omega + L) (D/omega)^-1 (D/omega + U)
+    A = A.tocsr()
+    D = A.diagonal() / omega
+    lower = (sp.tril(A, k=-1) + sp.diags(D)).tocsr()
+    upper = (sp.triu(A, k=1) + sp.diags(D)).tocsr()
+    def apply(r):
+        y = sp.linalg.spsolve_triangular(lower, np.ravel(r), lower=True)
+        return (2 - omega) / omega * sp.linalg.spsolve_triangular(upper, D * y, lower=False)
+    return sp.linalg.LinearOperator(A.shape, matvec=apply)
+
+def ic0_preconditioner(A):
+    # incomplete Cholesky with no fill-in: L has the sparsity of tril(A)
+    lower_A = sp.tril(A, format='csr')
+    lower_A.sort_indices()
+    n = A.shape[0]
+    rows = [dict() for i in range(n)]
+    for i in range(n):
+        start, end = lower_A.indptr[i], lower_A.indptr[i+1]
+        for k, a_ik in zip(lower_A.indices[start:end], lower_A.data[start:end]):
+            # the entries of row i computed so far are all in columns < k
+            s = a_ik - sum(l_ij * rows[k].get(j, 0) for j, l_ij in rows[i].items())
+            if k < i:
+                rows[i][k] = s / rows[k][k]
+            else:
+                rows[i][i] = np.sqrt(s)
+    L = sp.csr_matrix((
+        [v for row in rows for v in row.values()],
+        [j for row in rows for j in row.keys()],
+        np.cumsum([0] + [len(row) for row in rows])
+    ), shape=A.shape)
+    LT = L.T.tocsr()
+    def apply(r):
+        y = sp.linalg.spsolve_triangular(L, np.ravel(r), lower=True)
+        return sp.linalg.spsolve_triangular(LT, y, lower=False)
+    return sp.linalg.LinearOperator(A.shape, matvec=apply)
+
+def ilut_preconditioner(A, drop_tol=1e-4, fill_factor=10):
+    ilu = sp.linalg.spilu(A.tocsc(), drop_tol=drop_tol, fill_factor=fill_factor)
+    return sp.linalg.LinearOperator(A.shape, matvec=lambda r: ilu.solve(np.ravel(r)))
+
+def spai_preconditioner(A):
+    # sparse approximate inverse with the sparsity of A: each column m_j
+    # minimises |A m_j - e_j| using only the rows that A[:, J] touches.
+    # The result is symmetrised so that it can also be used with cg.
+    A = A.tocsc()
+    n = A.shape[0]
+    rows, cols, vals = [], [], []
+    for j in range(n):
+        J = A.indices[A.indptr[j]:A.indptr[j+1]]
+        I = np.unique(np.concatenate([A.indices[A.indptr[c]:A.indptr[c+1]] for c in J]))
+        A_IJ = np.zeros((len(I), len(J)))
+        for k, c in enumerate(J):
+            start, end = A.indptr[c], A.indptr[c+1]
+            A_IJ[np.searchsorted(I, A.indices[start:end]), k] = A.data[start:end]
+        e_j = (I == j).astype(float)
+        m_j = np.linalg.lstsq(A_IJ, e_j, rcond=None)[0]
+        rows.append(J)
+        cols.append(np.full(len(J), j))
+        vals.append(m_j)
+    M = sp.csr_matrix((np.concatenate(vals), (np.concatenate(rows), np.concatenate(cols))),
+                      shape=A.shape)
+    M = (M + M.T) / 2
+    return sp.linalg.aslinearoperator(M)
+
+# name: (builder, whether the preconditioner is symmetric and so usable with cg)
+preconditioners = {
+    'jacobi': (jacobi_preconditioner, True),
+    'ssor': (ssor_preconditioner, True),
+    'ic0': (ic0_preconditioner, True),
+    'ilut': (ilut_preconditioner, False),
+    'spai': (spai_preconditioner, True),
+}
+
+preconditioner_cache = {}
+
+def get_preconditioner(name, A):
+    # preconditioners are built once for each matrix, keyed on its contents
+    A = A.tocsr()
+    digest = hashlib.blake2b(digest_size=16)
+    for array in (A.indptr, A.indices, A.data):
+        digest.update(np.ascontiguousarray(array).tobytes())
+    key = (name, A.shape, digest.hexdigest())
+    if key not in preconditioner_cache:
+        builder, symmetric = preconditioners[name]
+        preconditioner_cache[key] = builder(A)
+    return preconditioner_cache[key]
+
+# geometric multigrid for the buildA problem. The grid is coarsened by
+# halving N, and the coarsest grid is solved directly.
+def interpolation(N, Nc):
+    # bilinear interpolation from the (Nc-1)^2 coarse to the (N-1)^2 fine
+    # points. For even N = 2 Nc the coarse points are every other fine point,
+    # and P^T / 4 is full weighting; for odd N they fall between fine points
+    x = np.arange(1, N) / N
+    y = np.arange(1, Nc) / Nc
+    P_1d = sp.csr_matrix(np.maximum(0, 1 - Nc * np.abs(x[:, np.newaxis] - y[np.newaxis, :])))
+    return sp.kron(P_1d, P_1d, format='csr')
+
+class Multigrid:
+    def __init__(self, N, cycle='V', smoothing_steps=2, omega=0.8, min_N=4):
+        self.cycle = cycle
+        self.smoothing_steps = smoothing_steps
+        self.omega = omega
+        self.Ns = [N]
+        while self.Ns[-1] // 2 >= min_N:
+            self.Ns.append(self.Ns[-1] // 2)
+        if len(self.Ns) < 2:
+            raise ValueError(f'N = {N} is too small to coarsen, multigrid needs N >= {2 * min_N}')
+        # the coarse operators are P^T A P (Galerkin), restriction is P^T
+        self.Ps = [interpolation(n, nc) for n, nc in zip(self.Ns[:-1], self.Ns[1:])]
+        self.As = [buildA(N).tocsr()]
+        for P in self.Ps:
+            self.As.append((P.T @ self.As[-1] @ P).tocsr())
+        self.invDs = [jacobi_preconditioner(A) for A in self.As]
+        self.coarse_lu = sp.linalg.splu(self.As[-1].tocsc())
+
+    def smooth(self, level, x, b):
+        # weighted jacobi, x += omega D^{-1} r
+        A = self.As[level]
+        for i in range(self.smoothing_steps):
+            x += self.omega * (self.invDs[level] @ (b - A @ x))
+        return x
+
+    def apply_cycle(self, level, x, b, cycle):
+        if level == len(self.Ns) - 1:
+            return self.coarse_lu.solve(b)
+        x = self.smooth(level, x, b)
+        rc = self.Ps[level].T @ (b - self.As[level] @ x)
+        ec = np.zeros_like(rc)
+        if cycle == 'V':
+            ec = self.apply_cycle(level + 1, ec, rc, 'V')
+        elif cycle == 'W':
+            ec = self.apply_cycle(level + 1, ec, rc, 'W')
+            ec = self.apply_cycle(level + 1, ec, rc, 'W')
+        elif cycle == 'F':
+            ec = self.apply_cycle(level + 1, ec, rc, 'F')
+            ec = self.apply_cycle(level + 1, ec, rc, 'V')
+        x += self.Ps[level] @ ec
+        return self.smooth(level, x, b)
+
+    def solve(self, b, x0=None, tol=1e-8, max_iter=100, telemetry=None):
+        if telemetry is None:
+            telemetry = SolverTelemetry(max_iter, enabled=False)
+        b = b.reshape(-1)
+        x = np.zeros_like(b) if x0 is None else np.copy(x0).reshape(-1)
+        b_norm = np.linalg.norm(b)
+        reason = 'max_iter'
+        for i in range(max_iter):
+            r = b - self.As[0] @ x
+            telemetry.matvecs += 1
+            error = np.linalg.norm(r) / b_norm
+            telemetry.record(error)
+            if error < tol:
+                reason = 'converged'
+                break
+            # each cycle is one application of the multigrid preconditioner
+            x = self.apply_cycle(0, x, b, self.cycle)
+            telemetry.preconditioner_applies += 1
+        if reason != 'converged' and telemetry.enabled:
+            # the last cycle was not checked
+            error = np.linalg.norm(b - self.As[0] @ x) / b_norm
+        telemetry.finish(reason, error)
+        return x, i
+
+    def as_preconditioner(self):
+        # one cycle from a zero initial guess approximates A^{-1}
+        n = self.As[0].shape[0]
+        return sp.linalg.LinearOperator(
+            (n, n), matvec=lambda b: self.apply_cycle(0, np.zeros(n), np.ravel(b), self.cycle),
+            dtype=float
+        )
+
+# iterations do not grow with N, odd or even
+for cycle in ['V', 'W', 'F']:
+    mg_iterations = []
+    for N in [16, 19, 32, 57, 64, 128]:
+        A = buildA(N)
+        f = buildf2(N)
+        x, iters = Multigrid(N, cycle=cycle).solve(f)
+        assert np.linalg.norm(A @ x - f.reshape(-1)) < 1e-8 * np.linalg.norm(f)
+        mg_iterations.append(iters)
+    print(cycle, 'cycle multigrid iterations for N = 16, 19, 32, 57, 64, 128:', mg_iterations)
+    assert max(mg_iterations) <= 12
+# a grid that cannot be coarsened at all is not multigrid
+try:
+    Multigrid(7)
+    assert False, 'Multigrid accepted a grid with a single level'
+except ValueError:
+    pass
+
+# and as a preconditioner for cg
+N = 64
+A = buildA(N)
+f = buildf2(N)
+x, info = sp.linalg.cg(A, f, M=Multigrid(N).as_preconditioner())
+assert info == 0
+
+def multigrid_solve(A, f):
+    N = int(round(np.sqrt(A.shape[0]))) + 1
+    mg = Multigrid(N)
+    x, iters = mg.solve(f)
+    return x, iters
+
+# buildA is the Dirichlet Laplacian on a uniform grid, which is diagonalised
+# by the 2D discrete sine transform (type 1), so it can be solved in
+# O(n log n) without forming the matrix. f is either (N-1)**2 long, with
+# optional extra columns, or in grid shape (..., N-1, N-1) for a batch.
+def fast_poisson_solve(f, N, workers=None):
+    f = np.asarray(f, dtype=float)
+    columns = f.ndim <= 2 and f.shape[0] == (N - 1)**2
+    if columns:
+        # put the grid last, with the columns as the batch dimension
+        F = f.reshape((N - 1, N - 1, -1)).transpose(2, 0, 1)
+    else:
+        F = f
+    # eigenvalues of the 1D second difference, summed over both directions
+    eig_1d = (2 - 2 * np.cos(np.pi * np.arange(1, N) / N)) * N**2
+    eig = eig_1d[:, np.newaxis] + eig_1d[np.newaxis, :]
+    F_hat = scipy.fft.dstn(F, type=1, axes=(-2, -1), workers=workers)
+    F_hat /= eig
+    X = scipy.fft.idstn(F_hat, type=1, axes=(-2, -1), workers=workers, overwrite_x=True)
+    if columns:
+        return X.transpose(1, 2, 0).reshape(f.shape)
+    return X
+
+# a batch in grid shape gives the same answer as the columns
+N = 10
+F = np.random.rand(3, N - 1, N - 1)
+np.testing.assert_almost_equal(
+    fast_poisson_solve(F, N),
+    fast_poisson_solve(F.reshape(3, -1).T, N).T.reshape(3, N - 1, N - 1)
+)
+np.testing.assert_almost_equal(buildA(N) @ fast_poisson_solve(buildf2(N), N), buildf2(N))
+
+def dst_solve(A, f):
+    N = int(round(np.sqrt(A.shape[0]))) + 1
+    return fast_poisson_solve(f, N, workers=-1)
+
+# sparse Cholesky. The symbolic phase (fill-reducing ordering, elimination
+# tree and the sparsity pattern of L) only depends on the pattern of A, so it
+# is done once, and numeric() can be re-run whenever the values change.
+#
+# The factorisation is supernodal and multifrontal: columns of L are grouped
+# into supernodes, subtrees of the elimination tree that are stored as one
+# dense block of L. Neighbouring columns usually have nearly the same rows,
+# and a supernode is grown while the explicit zeros this adds stay below
+# relaxed_supernodes. numeric() then visits the supernodes children first:
+# it assembles each dense front from A and the update matrices of its
+# children, factors the front with LAPACK and passes its own update matrix
+# to its parent. Both phases keep O(nnz(L)) data (with the explicit zeros),
+# and the Python loop is over supernodes, not over entries of L.
+def nested_dissection(A, min_size=64):
+    # split the graph of A with a level set of a breadth first search from a
+    # pseudo-peripheral node, order the two halves first and the separator last
+    graph = sp.csr_matrix(A, copy=True)
+    graph.data[:] = 1
+    order = []
+
+    def dissect(nodes):
+        if len(nodes) <= min_size:
+            order.extend(nodes)
+            return
+        subgraph = graph[nodes][:, nodes]
+        n_components, labels = sp.csgraph.connected_components(subgraph, directed=False)
+        if n_components > 1:
+            for c in range(n_components):
+                dissect(nodes[labels == c])
+            return
+        start = 0
+        for i in range(2):
+            levels = sp.csgraph.shortest_path(subgraph, indices=start, unweighted=True)
+            start = np.argmax(levels)
+        middle = levels.max() // 2
+        dissect(nodes[levels < middle])
+        dissect(nodes[levels > middle])
+        order.extend(nodes[levels == middle])
+
+    dissect(np.arange(A.shape[0]))
+    return np.array(order)
+
+# (largest number of columns, largest fraction of explicit zeros) for
+# merging a supernode into its parent
+relaxed_supernodes = [(32, 0.9), (64, 0.5), (np.inf, 0.1)]
+
+class SparseCholesky:
+    def __init__(self, A, ordering='nd'):
+        self.symbolic(A, ordering)
+        self.numeric(A)
+
+    def symbolic(self, A, ordering):
+        n = A.shape[0]
+        if ordering == 'nd':
+            perm = nested_dissection(A)
+        elif ordering == 'rcm':
+            perm = sp.csgraph.reverse_cuthill_mckee(sp.csr_matrix(A), symmetric_mode=True)
+        else:
+            perm = np.arange(n)
+        upper = sp.triu(sp.csc_matrix(A)[perm][:, perm], format='csc')
+        upper.sort_indices()
+        indptr, indices = upper.indptr.tolist(), upper.indices.tolist()
+
+        # elimination tree, with path compression
+        parent = [-1] * n
+        ancestor = [-1] * n
+        for k in range(n):
+            for i in indices[indptr[k]:indptr[k+1]]:
+                while i != -1 and i < k:
+                    i_next = ancestor[i]
+                    ancestor[i] = k
+                    if i_next == -1:
+                        parent[i] = k
+                    i = i_next
+
+        # row i of L is found by walking up the tree from each nonzero A[k, i]
+        rows, cols = [], []
+        mark = [-1] * n
+        for i in range(n):
+            mark[i] = i
+            rows.append(i)
+            cols.append(i)
+            for k in indices[indptr[i]:indptr[i+1]]:
+                while mark[k] != i:
+                    rows.append(i)
+                    cols.append(k)
+                    mark[k] = i
+                    k = parent[k]
+        pattern = sp.csc_matrix((np.ones(len(rows)), (rows, cols)), shape=(n, n))
+        pattern.sort_indices()
+        Lp, Li = pattern.indptr, pattern.indices
+        counts = np.diff(Lp).tolist()
+
+        # relaxed supernodes: every column starts as its own supernode, and
+        # the supernodes of its children are merged into it while the
+        # explicit zeros stay within relaxed_supernodes. A supernode keeps
+        # the rows below its top column, which contain those of all of its
+        # columns
+        children = [[] for j in range(n)]
+        for j in range(n):
+            if parent[j] != -1:
+                children[parent[j]].append(j)
+        size = [1] * n
+        nnz = list(counts)
+        merged_into = list(range(n))
+        for j in range(n):
+            for child in children[j]:
+                columns = size[j] + size[child]
+                stored = columns * (columns + 1) // 2 + columns * (counts[j] - 1)
+                zeros = 1 - (nnz[j] + nnz[child]) / stored
+                if any(columns <= max_columns and zeros <= max_zeros
+                       for max_columns, max_zeros in relaxed_supernodes):
+                    size[j] = columns
+                    nnz[j] += nnz[child]
+                    merged_into[child] = j
+        top = list(range(n))
+        for j in range(n - 1, -1, -1):
+            top[j] = top[merged_into[j]]
+        members = collections.defaultdict(list)
+        for j in range(n):
+            members[top[j]].append(j)
+        supernode_children = collections.defaultdict(list)
+        roots = []
+        for j in members:
+            if parent[j] == -1:
+                roots.append(j)
+            else:
+                supernode_children[top[parent[j]]].append(j)
+
+        # number the supernodes in postorder, so that the columns of each one
+        # are contiguous and children come before their parents. This only
+        # relabels the elimination tree, so L has the same fill
+        postorder = []
+        stack = [(j, False) for j in reversed(roots)]
+        while stack:
+            j, done = stack.pop()
+            if done:
+                postorder.append(j)
+                continue
+            stack.append((j, True))
+            stack.extend((child, False) for child in reversed(supernode_children[j]))
+        order = np.concatenate([members[j] for j in postorder])
+        inverse = np.empty(n, dtype=int)
+        inverse[order] = np.arange(n)
+        self.perm = perm[order]
+        self.parent = np.array([-1 if parent[j] == -1 else inverse[parent[j]] for j in order])
+
+        # the rows of each front are its own columns followed by the rows
+        # below its top column, and entry (i, j) of front k is at
+        # self.front_keys.searchsorted(k n + i)
+        index = {j: k for k, j in enumerate(postorder)}
+        sizes = np.array([size[j] for j in postorder])
+        self.starts = np.concatenate(([0], np.cumsum(sizes)))
+        self.fronts = [
+            np.concatenate((np.arange(start, start + c), np.sort(inverse[Li[Lp[j]+1:Lp[j+1]]])))
+            for j, start, c in zip(postorder, self.starts, sizes)
+        ]
+        front_sizes = np.array([len(front) for front in self.fronts])
+        self.front_offsets = np.concatenate(([0], np.cumsum(front_sizes)))
+        self.front_keys = np.concatenate([k * n + front for k, front in enumerate(self.fronts)])
+        self.column_supernode = np.repeat(np.arange(len(postorder)), sizes)
+        # the values of L are stored as a dense (front size, columns) block
+        # per supernode, starting at self.offsets[k]
+        self.offsets = np.concatenate(([0], np.cumsum(front_sizes * sizes)))
+        # (offset, front size, columns, [(child, rows in this front)])
+        self.supernodes = []
+        for k, j in enumerate(postorder):
+            relative = []
+            for child in map(index.get, supernode_children[j]):
+                rows = np.searchsorted(self.fronts[k], self.fronts[child][sizes[child]:])
+                relative.append((child, rows[:, np.newaxis], rows))
+            self.supernodes.append((self.offsets[k], front_sizes[k], sizes[k], relative))
+
+        self.fill_in = {
+            'nnz_A': int(sp.tril(A).nnz), 'nnz_L': int(pattern.nnz),
+            'fill_ratio': pattern.nnz / sp.tril(A).nnz, 'flops': int(np.sum(np.square(counts))),
+            'supernodes': len(self.supernodes), 'stored_L': int(self.offsets[-1]),
+        }
+
+    def numeric(self, A):
+        n = A.shape[0]
+        lower = sp.tril(sp.csc_matrix(A)[self.perm][:, self.perm], format='csc')
+        lower.sort_indices()
+        # scatter A into the blocks of L
+        columns = np.repeat(np.arange(n), np.diff(lower.indptr))
+        supernodes = self.column_supernode[columns]
+        keys = supernodes.astype(np.int64) * n + lower.indices
+        positions = self.front_keys.searchsorted(keys)
+        if np.any(positions == len(self.front_keys)) or np.any(self.front_keys[positions] != keys):
+            raise ValueError('A has nonzeros outside the pattern of the symbolic phase')
+        sizes = np.diff(self.starts)
+        self.Lx = np.zeros(self.offsets[-1])
+        self.Lx[self.offsets[supernodes]
+                + (positions - self.front_offsets[supernodes]) * sizes[supernodes]
+                + columns - self.starts[supernodes]] = lower.data
+
+        updates = {}
+        for k, (offset, m, c, relative) in enumerate(self.supernodes):
+            block = self.Lx[offset:offset + m * c].reshape(m, c)
+            # the front, with the update matrices of the children added
+            front = block
+            if relative:
+                front = np.zeros((m, m))
+                front[:, :c] = block
+                for child, rows_column, rows in relative:
+                    front[rows_column, rows] += updates.pop(child)
+            L11, info = scipy.linalg.lapack.dpotrf(front[:c, :c], lower=1, clean=1)
+            if info != 0:
+                raise np.linalg.LinAlgError('matrix is not positive definite')
+            block[:c] = L11
+            if m > c:
+                # L21 = F21 L11^-T, and the update matrix F22 - L21 L21^T
+                L21 = scipy.linalg.blas.dtrsm(1.0, L11, front[c:, :c], side=1, lower=1, trans_a=1)
+                block[c:] = L21
+                updates[k] = (front[c:, c:] if relative else 0) - L21 @ L21.T
+
+    def solve(self, b):
+        y = np.array(np.asarray(b)[self.perm], dtype=float)
+        blocks = [self.Lx[offset:offset + m * c].reshape(m, c)
+                  for offset, m, c, _ in self.supernodes]
+        # L y = b, then L^T x = y, a supernode at a time
+        for start, front, block in zip(self.starts, self.fronts, blocks):
+            c = block.shape[1]
+            y[start:start + c] = scipy.linalg.solve_triangular(
+                block[:c], y[start:start + c], lower=True, check_finite=False)
+            y[front[c:]] -= block[c:] @ y[start:start + c]
+        for start, front, block in reversed(list(zip(self.starts, self.fronts, blocks))):
+            c = block.shape[1]
+            y[start:start + c] = scipy.linalg.solve_triangular(
+                block[:c], y[start:start + c] - block[c:].T @ y[front[c:]],
+                lower=True, trans='T', check_finite=False)
+        x = np.empty_like(y)
+        x[self.perm] = y
+        return x
+
+# block Krylov solvers for k right-hand sides at once, B has shape (n, k).
+# Each iteration does a single sparse matrix times dense block product, and
+# columns are dropped from the block (deflated) once they have converged.
+def orthonormal_columns(Z, rtol=1e-12):
+    # an orthonormal basis for the columns of Z, dropping any that are
+    # (nearly) linearly dependent so the small block systems stay regular
+    U, s, _ = np.linalg.svd(Z, full_matrices=False)
+    return U[:, s > rtol * s[0]]
+
+def block_cg(A, B, tol=1e-5, max_iter=1000):
+    B = B.reshape(B.shape[0], -1)
+    X = np.zeros_like(B, dtype=float)
+    b_norms = np.linalg.norm(B, axis=0)
+    residuals = [np.ones(B.shape[1])]
+    active = np.flatnonzero(b_norms > 0)
+    R = B[:, active].astype(float)
+    P = orthonormal_columns(R)
+    matvecs = 0
+    for i in range(max_iter):
+        if len(active) == 0:
+            break
+        Q = A @ P
+        matvecs += P.shape[1]
+        PQ = P.T @ Q
+        alpha = np.linalg.solve(PQ, P.T @ R)
+        X[:, active] += P @ alpha
+        R -= Q @ alpha
+
+        error = np.full(B.shape[1], np.nan)
+        error[active] = np.linalg.norm(R, axis=0) / b_norms[active]
+        residuals.append(error)
+        keep = error[active] >= tol
+        active, R = active[keep], R[:, keep]
+        if len(active) == 0:
+            break
+        # keep the new search directions A-conjugate to the current ones
+        beta = -np.linalg.solve(PQ, Q.T @ R)
+        P = orthonormal_columns(R + P @ beta)
+    return X, i, {'matvecs': matvecs, 'residuals': np.array(residuals)}
+
+def block_gmres(A, B, tol=1e-5, restart=20, max_iter=100):
+    # restarted block GMRES: one sparse product of A with the block of basis
+    # vectors per iteration, and converged columns are deflated at each
+    # restart. The residuals to restart from come from the Arnoldi relation
+    # R = V (E - H Y), so restarts need no extra products with A.
+    # A cycle searches a space of restart * (number of columns) vectors,
+    # where separate GMRES(restart) runs each search restart vectors, so it
+    # pays off when restarted GMRES stalls, e.g. on diffusion dominated
+    # problems, and when a product with A costs more than orthogonalising
+    # against the larger basis. For symmetric positive definite A block_cg
+    # is cheaper, and convection dominated systems converge within a few
+    # cycles anyway and are better solved one column at a time
+    B = B.reshape(B.shape[0], -1)
+    X = np.zeros_like(B, dtype=float)
+    R = np.array(B, dtype=float)
+    b_norms = np.linalg.norm(B, axis=0)
+    residuals = [np.ones(B.shape[1])]
+    matvecs = 0
+    for i in range(max_iter):
+        error = np.linalg.norm(R, axis=0) / np.where(b_norms > 0, b_norms, 1)
+        active = np.flatnonzero(error >= tol)
+        if len(active) == 0:
+            break
+        s = len(active)
+        V, S = np.linalg.qr(R[:, active])
+        Vs = [V]
+        H = np.zeros(((restart + 1) * s, restart * s))
+        for j in range(restart):
+            W = A @ Vs[j]
+            matvecs += s
+            for l in range(j + 1):
+                H_lj = Vs[l].T @ W
+                W -= Vs[l] @ H_lj
+                H[l*s:(l+1)*s, j*s:(j+1)*s] = H_lj
+            V, H[(j+1)*s:(j+2)*s, j*s:(j+1)*s] = np.linalg.qr(W)
+            Vs.append(V)
+            # the small least squares problem gives each column's residual
+            E = np.zeros(((j + 2) * s, s))
+            E[:s] = S
+            Y = np.linalg.lstsq(H[:(j+2)*s, :(j+1)*s], E, rcond=None)[0]
+            error = np.full(B.shape[1], np.nan)
+            error[active] = (np.linalg.norm(E - H[:(j+2)*s, :(j+1)*s] @ Y, axis=0)
+                             / b_norms[active])
+            residuals.append(error)
+            if np.all(error[active] < tol):
+                break
+        X[:, active] += np.concatenate(Vs[:j+1], axis=1) @ Y
+        R[:, active] = np.concatenate(Vs[:j+2], axis=1) @ (E - H[:(j+2)*s, :(j+1)*s] @ Y)
+    return X, i, {'matvecs': matvecs, 'residuals': np.array(residuals)}
+
+# solve(A, b, method='auto') picks a method from cheap checks of A and from
+# the timings that the sweep below writes to unit_2_7_memory.json
+logger = logging.getLogger('unit_2_7')
+
+def matrix_properties(A):
+    A = sp.csr_matrix(A)
+    n = A.shape[0]
+    diagonal = A.diagonal()
+    abs_A = abs(A)
+    off_diagonal = np.asarray(abs_A.sum(axis=1)).ravel() - np.abs(diagonal)
+    coo = A.tocoo()
+    return {
+        'n': n,
+        'density': A.nnz / n**2,
+        'symmetric': bool(abs(A - A.T).max() <= 1e-12 * abs_A.max()),
+        'positive_diagonal': bool(np.all(diagonal > 0)),
+        'diagonally_dominant': bool(np.all(np.abs(diagonal) >= off_diagonal)),
+        'bandwidth': int(np.max(np.abs(coo.row - coo.col), initial=0)),
+    }
+
+def load_timings(filename='unit_2_7_memory.json'):
+    # fit a power law time = a n^b to the recorded times of each solver.
+    # Only the buildf2 right-hand side (rhs=1) is used, as the iterative
+    # solvers take a different number of iterations for each right-hand side
+    try:
+        with open(filename) as file:
+            records = json.load(file)
+    except FileNotFoundError:
+        return {}
+    records = [r for r in records if r['rhs'] == 1]
+    fits = {}
+    for solver in set(r['solver'] for r in records):
+        n = np.array([(r['N'] - 1)**2 for r in records if r['solver'] == solver])
+        t = np.array([r['time'] for r in records if r['solver'] == solver])
+        if len(np.unique(n)) > 1:
+            fits[solver] = np.polyfit(np.log(n), np.log(t), 1)
+    return fits
+
+def choose_method(A, timings=None, max_dense_size=10**4):
+    properties = matrix_properties(A)
+    n = properties['n']
+    # diagonally dominant, symmetric, with a positive diagonal means SPD
+    spd = (properties['symmetric'] and properties['positive_diagonal']
+           and properties['diagonally_dominant'])
+    candidates = ['gmres', 'bicgstab']
+    if spd:
+        candidates.append('cg')
+    # never make a dense copy of a large matrix
+    if n <= max_dense_size:
+        candidates.append('lu')
+        if spd:
+            candidates.append('cholesky')
+
+    if timings is None:
+        timings = load_timings()
+    expected = {
+        method: np.exp(np.polyval(timings[method], np.log(n)))
+        for method in candidates if method in timings
+    }
+    if expected:
+        method = min(expected, key=expected.get)
+    elif n <= max_dense_size:
+        method = 'cholesky' if spd else 'lu'
+    else:
+        method = 'cg' if spd else 'gmres'
+    logger.info('solve: n=%d, properties=%s, expected times=%s, chose %s',
+                n, properties, expected, method)
+    return method
+
+def solve(A, b, method='auto'):
+    if method == 'auto':
+        method = choose_method(A)
+    if method == 'lu':
+        return lu_solve(sp.csr_matrix(A).toarray(), b)[1]
+    if method == 'cholesky':
+        return cho_solve(sp.csr_matrix(A), b)[1]
+    if method == 'inv':
+        return inv_solve(sp.csr_matrix(A).toarray(), b)[1]
+    if method == 'sparse_cholesky':
+        return SparseCholesky(A).solve(np.ravel(b)).reshape(np.shape(b))
+    solvers = {'cg': sp.linalg.cg, 'bicgstab': sp.linalg.bicgstab, 'gmres': sp.linalg.gmres}
+    x, info = solvers[method](A, b)
+    if info != 0:
+        # not converged (info > 0) or broken down (info < 0), so do not
+        # return the last iterate, fall back to a sparse direct solve instead
+        logger.warning('solve: %s stopped with info=%d (%s), falling back to spsolve',
+                       method, info, reason_from_info(info))
+        x = sp.linalg.spsolve(sp.csc_matrix(A), b)
+    return x.reshape(np.shape(b))
+
+# every (right-hand side, N, method) cell of the sweep is independent, so
+# they are run over a process pool. Each cell checks its solution against
+# spsolve
+methods = ['lu', 'cholesky', 'inv', 'cg', 'bicgstab', 'gmres', 'multigrid', 'dst']
+
+def sweep_cell(j, N, method):
+    print('doing j=',j,' and N=',N,' with',method)
+    A = buildA(N)
+    f = (buildf1, buildf2)[j](N)
+    x_exact = sp.linalg.spsolve(A.tocsc(), f).reshape(-1, 1)
+    iters = np.nan
+    factor_nnz = 0
+    if method == 'lu':
+        (lu_A, x), stats = measure(lu_solve, A.toarray(), f)
+        factor_nnz = lu_A[0].size
+        np.testing.assert_almost_equal(A @ x, f)
+    elif method == 'cholesky':
+        (cho_A, x), stats = measure(cho_solve, A, f)
+        factor_nnz = cho_A[0].size
+        np.testing.assert_almost_equal(A @ x, f)
+    elif method == 'inv':
+        (invA, x), stats = measure(inv_solve, A.toarray(), f)
+        factor_nnz = invA.size
+    elif method in ['cg', 'bicgstab', 'gmres']:
+        (x, iters), stats = measure(krylov_solve, getattr(sp.linalg, method), A, f)
+    elif method == 'multigrid':
+        (x, iters), stats = measure(multigrid_solve, A, f)
+    elif method == 'dst':
+        x, stats = measure(dst_solve, A, f)
+    # the iterative solvers are only accurate to their tolerance
+    decimal = 7 if np.isnan(iters) else 5
+    np.testing.assert_almost_equal(x.reshape(-1, 1), x_exact, decimal=decimal)
+
+    if method == 'cg':
+        # the Krylov solvers only need matvecs, so also work matrix-free
+        x_matrix_free, info = sp.linalg.cg(LaplacianOperator(N), f)
+        np.testing.assert_almost_equal(x_matrix_free.reshape(-1, 1), x_exact,
+                                       decimal=5)
+    return {
+        'times': stats['time'], 'iterations': iters,
+        'record': dict(solver=method, N=int(N), rhs=j, factor_nnz=factor_nnz, **stats),
+    }
+
 num = 20
-times = np.empty((num, 2, 6), dtype=float)
-iterations = np.empty((num, 2, 3), dtype=int)
+times = np.empty((num, 2, len(methods)), dtype=float)
+all_iterations = np.empty((num, 2, len(methods)), dtype=float)
 times[:] = np.nan
-iterations[:] = np.nan
+all_iterations[:] = np.nan
 Ns = np.logspace(0.5, 2.0, num=num, dtype=int)
-for j, buildf in enumerate((buildf1, buildf2)):
-    for i, N in enumerate(Ns):
-        print('doing j=',j,' and N=',N)
-        A = buildA(N)
-        Adense = A.toarray()
-        f = buildf(N)
+cells = {
+    (i, j, k): (j, N, method)
+    for j in range(2) for i, N in enumerate(Ns) for k, method in enumerate(methods)
+    if (method != 'inv' or N <= 64) and (method != 'multigrid' or N >= 8)
+}
+results = sweep.run_sweep(
+    sweep_cell, cells, outputs={'times': times, 'iterations': all_iterations},
+    checkpoint='unit_2_7_sweep.jsonl', timeout=600
+)
+# cg, bicgstab, gmres and multigrid
+iterations = all_iterations[:, :, 3:7]
+records = [results[index]['record'] for index in sorted(results)]
 
-        t0 = time.perf_counter()
-        lu_A = scipy.linalg.lu_factor(Adense)
-        x_using_lu = scipy.linalg.lu_solve(lu_A, f)
-        t1 = time.perf_counter()
-        times[i, j, 0] = t1 - t0
-        np.testing.assert_almost_equal(A @ x_using_lu, f)
+# memory statistics, next to the timings
+with open('unit_2_7_memory.json', 'w') as file:
+    json.dump(records, file, indent=1)
 
-        t0 = time.perf_counter()
-        cho_A = scipy.linalg.cho_factor(A.toarray())
-        x_using_cho = scipy.linalg.cho_solve(cho_A, f)
-        t1 = time.perf_counter()
-        np.testing.assert_almost_equal(A @ x_using_cho, f)
-        np.testing.assert_almost_equal(x_using_cho, x_using_lu)
-        times[i, j, 1] = t1 - t0
+# the automatic solver uses these timings
+logging.basicConfig(level=logging.INFO)
+for N in [10, 50, 200]:
+    A = buildA(N)
+    f = buildf2(N)
+    x = solve(A, f)
+    assert np.linalg.norm(A @ x - f) < 1e-4 * np.linalg.norm(f)
+assert choose_method(buildA(1001)) in ['cg', 'bicgstab', 'gmres']
+# a Krylov solver that does not converge falls back to a direct solve
+A = sp.random(200, 200, density=0.02, random_state=0, format='csr') + 0.01 * sp.eye(200)
+b = np.ones(200)
+np.testing.assert_allclose(A @ solve(A, b, method='cg'), b)
 
-        if N <= 64:
-            t0 = time.perf_counter()
-            invA = scipy.linalg.inv(Adense)
-            x_using_inv = invA @ f
-            t1 = time.perf_counter()
-            np.testing.assert_almost_equal(x_using_inv, x_using_lu)
-            times[i, j, 2] = t1 - t0
+# fill-in of the sparse Cholesky factor for each ordering, and the cost of
+# refactoring with new values once the symbolic phase is done
+N = 64
+A = buildA(N)
+f = buildf2(N)
+for ordering in ['natural', 'rcm', 'nd']:
+    chol = SparseCholesky(A, ordering)
+    np.testing.assert_almost_equal(chol.solve(f.ravel()), sp.linalg.spsolve(A.tocsc(), f))
+    print(ordering, 'ordering:', chol.fill_in)
+# and a less regular pattern, where supernodes merge several children
+M = sp.random(300, 300, density=0.01, rng=0, format='csr')
+A_random = M @ M.T + sp.eye(300)
+b = np.random.rand(300)
+for ordering in ['natural', 'rcm', 'nd']:
+    np.testing.assert_allclose(SparseCholesky(A_random, ordering).solve(b),
+                               sp.linalg.spsolve(A_random.tocsc(), b))
+N = 128
+A = buildA(N)
+f = buildf2(N)
+t0 = time.perf_counter()
+chol = SparseCholesky(A)
+t1 = time.perf_counter()
+A_shifted = A + sp.eye(A.shape[0])
+# best of a few runs, as the refactorisation should beat a fresh splu
+refactor_times, splu_times = [], []
+for repeat in range(3):
+    t2 = time.perf_counter()
+    chol.numeric(A_shifted)
+    t3 = time.perf_counter()
+    sp.linalg.splu(A_shifted.tocsc())
+    t4 = time.perf_counter()
+    refactor_times.append(t3 - t2)
+    splu_times.append(t4 - t3)
+np.testing.assert_almost_equal(chol.solve(f.ravel()), sp.linalg.spsolve(A_shifted.tocsc(), f))
+print('symbolic and numeric factorisation took', t1 - t0, 'refactorisation took',
+      min(refactor_times), 'versus', min(splu_times), 'for splu, with', chol.fill_in)
+assert min(refactor_times) < min(splu_times)
+# matrices that are not positive definite are rejected
+try:
+    chol.numeric(A - sp.eye(A.shape[0]) * A.diagonal()[0])
+    assert False, 'SparseCholesky accepted an indefinite matrix'
+except np.linalg.LinAlgError:
+    pass
 
-        global iters
-        def count_iters(x):
-            global iters
-            iters += 1
+# assembled matrices and their factors are cached on disk between runs, and
+# reloaded memory-mapped instead of being rebuilt
+def splu_buildA(N):
+    return sp.linalg.splu(buildA(N).tocsc())
 
-        iters = 0
-        t0 = time.perf_counter()
-        x_using_cg, info = sp.linalg.cg(A, f, callback=count_iters)
-        t1 = time.perf_counter()
-        np.testing.assert_almost_equal(x_using_cg.reshape(-1, 1), x_using_lu,
-                                       decimal=5)
-        iterations[i, j, 0] = iters
-        times[i, j, 3] = t1 - t0
+cache = disk_cache.DiskCache('cache')
+N = 200
+f = buildf2(N)
+for attempt in ['first', 'second']:
+    t0 = time.perf_counter()
+    A = cache.get('buildA', buildA, N)
+    splu_A = cache.get('splu_buildA', splu_buildA, N)
+    t1 = time.perf_counter()
+    np.testing.assert_almost_equal(splu_A.solve(f), fast_poisson_solve(f, N))
+    print(attempt, 'cache lookup took', t1 - t0, 'hits', cache.hits, 'misses', cache.misses)
+assert cache.hits >= 2
+# the reloaded factors solve in SuperLU's compiled triangular solves, once
+# the first solve has handed them over
+splu_solve_times = []
+for splu_object in [splu_buildA(N), splu_A]:
+    splu_object.solve(f)
+    t0 = time.perf_counter()
+    for i in range(3):
+        splu_object.solve(f)
+    splu_solve_times.append(time.perf_counter() - t0)
+print('splu solves took', splu_solve_times[0], 'seconds, and from the cache',
+      splu_solve_times[1])
+assert splu_solve_times[1] < 3 * splu_solve_times[0]
 
-        iters = 0
-        t0 = time.perf_counter()
-        x_using_bicgstab, info = sp.linalg.bicgstab(A, f, callback=count_iters)
-        t1 = time.perf_counter()
-        np.testing.assert_almost_equal(x_using_bicgstab.reshape(-1, 1), x_using_lu,
-                                       decimal=5)
-        iterations[i, j, 1] = iters
-        times[i, j, 4] = t1 - t0
+# numpy integers give the same key, and the stamp of splu_buildA covers
+# buildA, so editing buildA invalidates the cached factors as well
+cache.get('buildA', buildA, np.int64(N))
+assert cache.hits >= 3
+assert buildA in disk_cache.referenced_functions(splu_buildA)
+# a store that was killed part way leaves a temporary directory, which is
+# removed once it is old enough
+orphan = os.path.join(cache.directory, 'orphan.12345.tmp')
+os.makedirs(orphan, exist_ok=True)
+os.utime(orphan, (0, 0))
+cache.evict()
+assert not os.path.exists(orphan)
+
+# dense factors from scipy.linalg come back as tuples of memory-mapped
+# arrays, which LAPACK is given as they are
+def lu_factor_buildA(N):
+    return scipy.linalg.lu_factor(buildA(N).toarray())
 
-        iters = 0
+def cho_factor_buildA(N):
+    return scipy.linalg.cho_factor(buildA(N).toarray())
+
+N = 20
+f = buildf2(N)
+x_exact = fast_poisson_solve(f, N)
+for attempt in ['first', 'second']:
+    lu_A = cache.get('lu_factor_buildA', lu_factor_buildA, N)
+    cho_A = cache.get('cho_factor_buildA', cho_factor_buildA, N)
+    np.testing.assert_almost_equal(scipy.linalg.lu_solve(lu_A, f), x_exact)
+    np.testing.assert_almost_equal(scipy.linalg.cho_solve(cho_A, f), x_exact)
+assert isinstance(lu_A[0], np.memmap) and isinstance(cho_A[1], bool)
+
+# telemetry from the iterative solvers, written as json lines
+exporter = JsonLinesExporter('unit_2_7_telemetry.jsonl')
+N = 64
+A = buildA(N)
+f = buildf2(N)
+solver_telemetry = []
+solutions = []
+for name, solver in [('cg', sp.linalg.cg), ('bicgstab', sp.linalg.bicgstab),
+                     ('gmres', sp.linalg.gmres)]:
+    solver_telemetry.append(SolverTelemetry(exporter=exporter, solver=name, N=N))
+    solutions.append(krylov_solve(solver, A, f, M=get_preconditioner('jacobi', A),
+                                  telemetry=solver_telemetry[-1])[0])
+solver_telemetry.append(SolverTelemetry(exporter=exporter, solver='multigrid', N=N))
+solutions.append(Multigrid(N).solve(f, telemetry=solver_telemetry[-1])[0])
+for t, x in zip(solver_telemetry, solutions):
+    assert t.reason == 'converged' and t.matvecs >= t.iterations - 1
+    # the true residual of the returned solution, whatever the solver recorded
+    np.testing.assert_allclose(t.final_residual, np.linalg.norm(f.ravel() - A @ x) / np.linalg.norm(f))
+    assert t.final_residual < 1e-4
+    print(t.labels['solver'], ':', t.iterations, 'iterations,', t.matvecs, 'matvecs,',
+          t.preconditioner_applies, 'preconditioner applications, final residual',
+          t.final_residual, '(recorded residuals are', t.residual_type + ') in',
+          t.total_time, 'seconds')
+    plt.semilogy(t.times, t.residuals, label=t.labels['solver'])
+plt.xlabel('time')
+plt.ylabel('relative residual')
+plt.legend()
+plt.show()
+
+# the multithreaded CSR operator is a drop-in replacement for A in the Krylov
+# solvers, optionally storing the values of A in single precision
+N = 300
+A = buildA(N).tocsr()
+f = buildf2(N)
+x_exact = fast_poisson_solve(f, N).reshape(-1)
+with ParallelCSR(A) as A_parallel, ParallelCSR(A, dtype=np.float32) as A_single:
+    for label, operator in [('scipy.sparse', A), ('ParallelCSR', A_parallel),
+                            ('ParallelCSR float32', A_single)]:
         t0 = time.perf_counter()
-        x_using_gmres, info = sp.linalg.gmres(A, f, callback=count_iters)
+        x, iters = krylov_solve(sp.linalg.cg, operator, f)
         t1 = time.perf_counter()
-        np.testing.assert_almost_equal(x_using_gmres.reshape(-1, 1), x_using_lu,
-                                       decimal=5)
-        iterations[i, j, 2] = iters
-        times[i, j, 5] = t1 - t0
+        assert np.linalg.norm(x - x_exact) < 1e-4 * np.linalg.norm(x_exact)
+        print(label, 'cg took', t1 - t0, 'seconds and', iters, 'iterations')
+    # single precision values are upcast a chunk at a time, never all at once
+    _, stats = measure(A_single.matvec, f)
+    print('ParallelCSR float32 matvec peak memory', stats['peak_traced_memory'],
+          'bytes, versus', A.data.nbytes, 'bytes for the values of A in double precision')
+    assert stats['peak_traced_memory'] < A.data.nbytes / 2
+    # products running concurrently from several threads each upcast into
+    # their own buffer
+    xs = np.random.rand(8, A.shape[0])
+    with concurrent.futures.ThreadPoolExecutor(4) as executor:
+        products = list(executor.map(A_single.matvec, xs))
+    for x, product in zip(xs, products):
+        np.testing.assert_allclose(product, A.astype(np.float32) @ x, rtol=1e-10)
+    # and the adjoint runs on the same threads, instead of starting its own
+    assert A_single.H.pool is A_single.pool
+    np.testing.assert_allclose(A_single.H @ f, A_single @ f, rtol=1e-10)
+
+# both right-hand sides, plus a few random ones, solved together. The block
+# solvers share one sparse product per iteration across all the columns, and
+# block cg needs fewer matrix-vector products than solving each column with cg
+N = 64
+A = buildA(N).tocsr()
+B = np.concatenate([buildf1(N), buildf2(N), np.random.rand((N-1)**2, 4)], axis=1)
+X_exact = sp.linalg.spsolve(A.tocsc(), B)
+separate_matvecs = 0
+for k in range(B.shape[1]):
+    cg_telemetry = SolverTelemetry()
+    krylov_solve(sp.linalg.cg, A, B[:, k], telemetry=cg_telemetry, rtol=1e-8)
+    separate_matvecs += cg_telemetry.matvecs
+print('separate cg: matrix-vector products', separate_matvecs)
+for block_solver in [block_cg, block_gmres]:
+    t0 = time.perf_counter()
+    X, block_iters, info = block_solver(A, B, tol=1e-8)
+    t1 = time.perf_counter()
+    np.testing.assert_allclose(X, X_exact, atol=1e-7 * np.abs(X_exact).max())
+    print(block_solver.__name__, ': iterations', block_iters, 'matrix-vector products',
+          info['matvecs'], 'time', t1 - t0)
+# f1 is an eigenvector of A, so its column converges first and is deflated
+assert np.isnan(block_cg(A, B, tol=1e-8)[2]['residuals'][2, 0])
+
+# block cg is the better choice above, but block gmres also takes
+# nonsymmetric A. With a little convection added to the diffusion, separate
+# GMRES(20) runs keep stalling at their restarts, and the larger space that
+# block gmres searches per cycle needs far fewer matrix-vector products
+e = np.ones(N - 1)
+convection = sp.kron(sp.eye(N - 1), sp.spdiags([-e, e], [-1, 1], N - 1, N - 1) * N / 2)
+A_convection = (A + convection).tocsr()
+X_exact = sp.linalg.spsolve(A_convection.tocsc(), B)
+separate_matvecs = 0
+for k in range(B.shape[1]):
+    gmres_telemetry = SolverTelemetry()
+    krylov_solve(sp.linalg.gmres, A_convection, B[:, k], telemetry=gmres_telemetry,
+                 rtol=1e-8, restart=20, maxiter=1000)
+    separate_matvecs += gmres_telemetry.matvecs
+X, block_iters, info = block_gmres(A_convection, B, tol=1e-8, restart=20, max_iter=1000)
+np.testing.assert_allclose(X, X_exact, atol=1e-6 * np.abs(X_exact).max())
+print('convection-diffusion, separate gmres: matrix-vector products', separate_matvecs,
+      'block_gmres:', info['matvecs'])
+assert info['matvecs'] < separate_matvecs
 
 plt.loglog(Ns, times[:,0,:], ls='-')
 plt.gca().set_prop_cycle(None)
 plt.loglog(Ns, times[:,1,:], ls='--')
 plt.xlabel('N')
 plt.ylabel('time')
-plt.legend(['lu', 'cholesky', 'inv', 'cg', 'bicgstab', 'gmres'])
+plt.legend(['lu', 'cholesky', 'inv', 'cg', 'bicgstab', 'gmres', 'multigrid', 'dst'])
 plt.show()
 
 plt.loglog(Ns, iterations[:,0,:], ls='-')
@@ -114,7 +1064,52 @@ plt.gca().set_prop_cycle(None)
 plt.loglog(Ns, iterations[:,1,:], ls='--')
 plt.xlabel('N')
 plt.ylabel('iterations')
-plt.legend(['cg', 'bicgstab', 'gmres'])
+plt.legend(['cg', 'bicgstab', 'gmres', 'multigrid'])
+plt.show()
+
+# setup and solve times with each preconditioner, using f2 as f1 only takes
+# a single iteration. Symmetric preconditioners are used with cg, the others
+# with gmres
+precond_names = ['none'] + list(preconditioners)
+precond_setup_times = np.zeros((num, len(precond_names)), dtype=float)
+precond_solve_times = np.empty((num, len(precond_names)), dtype=float)
+precond_iterations = np.empty((num, len(precond_names)), dtype=float)
+for i, N in enumerate(Ns):
+    A = buildA(N).tocsr()
+    f = buildf2(N)
+    x_exact = sp.linalg.spsolve(A.tocsc(), f)
+    for p, name in enumerate(precond_names):
+        M = None
+        solver = sp.linalg.cg
+        if name != 'none':
+            t0 = time.perf_counter()
+            M = get_preconditioner(name, A)
+            t1 = time.perf_counter()
+            precond_setup_times[i, p] = t1 - t0
+            assert get_preconditioner(name, A) is M
+            if not preconditioners[name][1]:
+                solver = sp.linalg.gmres
+
+        t0 = time.perf_counter()
+        x, iters = krylov_solve(solver, A, f, M=M)
+        t1 = time.perf_counter()
+        precond_solve_times[i, p] = t1 - t0
+        precond_iterations[i, p] = iters
+        np.testing.assert_almost_equal(x, x_exact, decimal=5)
+    preconditioner_cache.clear()
+
+fig, axs = plt.subplots(1, 3, figsize=(15, 4))
+axs[0].loglog(Ns, precond_setup_times[:, 1:])
+axs[0].set_ylabel('setup time')
+axs[0].legend(precond_names[1:])
+axs[1].loglog(Ns, precond_setup_times + precond_solve_times)
+axs[1].set_ylabel('setup + solve time')
+axs[1].legend(precond_names)
+axs[2].loglog(Ns, precond_iterations)
+axs[2].set_ylabel('iterations')
+axs[2].legend(precond_names)
+for ax in axs:
+    ax.set_xlabel('N')
 plt.show()
 
 # Krylov subspace solvers only take 1 iteration to solve with b = f1 because x is a